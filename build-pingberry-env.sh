@@ -1,3 +1,15 @@
+# Options:
+#   --trim   ship only the modules the client imports, precompiled (see trim_runtime.py)
+#   --zip    with --trim, put the standard library in one zipimport archive
+TRIM=0
+TRIM_ARGS=""
+for arg in "$@"; do
+    case "$arg" in
+        --trim) TRIM=1 ;;
+        --zip) TRIM_ARGS="$TRIM_ARGS --zip" ;;
+    esac
+done
+
 # Remove old zip
 [ -f pingberry-env.zip ] && rm pingberry-env.zip
 
@@ -10,8 +22,13 @@ cp -r client/* pingberry-env/
 # Remove documentation/sample files
 rm pingberry-env/app/mqtt_credentials.example.jsonc
 
-# Zip the new folder
-zip -r pingberry-env.zip pingberry-env
+# Trim the runtime (needs python3.11 on this machine)
+if [ "$TRIM" -eq 1 ]; then
+    python3.11 trim_runtime.py pingberry-env $TRIM_ARGS || { rm -r pingberry-env; exit 1; }
+fi
+
+# Zip the new folder (-n: also compress lib/python311.zip, which zip would store as is)
+zip -r -n .none pingberry-env.zip pingberry-env
 
 # Clean up
 rm -r pingberry-env
@@ -0,0 +1,106 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger("catch_up")
+
+
+class CatchUp:
+    """
+    Collapses bursts of notifications, such as the backlog the broker delivers after a reconnect.
+
+    Outside a burst, messages are delivered as they arrive. Right after connecting, or once a
+    message arrives within `burst_interval` seconds of the previous one being handled, messages
+    are held until none has arrived for `quiet_period` seconds (or `max_pending` are held).
+    Then only the newest message per itemid is decrypted in full and delivered, oldest first:
+    PPS replaces a notification with the same itemid anyway, so the end state is the same.
+
+    `resolve_itemid(payload)` returns (itemid, fields decrypted so far) and should decrypt as
+    little as it can; `deliver(payload, fields)` decrypts the rest and shows the notification.
+    """
+
+    def __init__(self, resolve_itemid, deliver, burst_interval=0.2, quiet_period=0.5, max_pending=200):
+        self.resolve_itemid = resolve_itemid
+        self.deliver = deliver
+        self.burst_interval = burst_interval
+        self.quiet_period = quiet_period
+        self.max_pending = max_pending
+        self.active = False
+        self._pending = []
+        self._last_arrival = 0.0
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="catch-up", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def arm(self):
+        """Expect a backlog: hold messages until the connection has been quiet for a while."""
+        with self._condition:
+            self.active = True
+            self._last_arrival = time.monotonic()
+            self._condition.notify()
+
+    def submit(self, payload):
+        with self._condition:
+            now = time.monotonic()
+            if self.active or now - self._last_arrival < self.burst_interval:
+                self.active = True
+                self._pending.append(payload)
+                self._last_arrival = now
+                self._condition.notify()
+                return
+
+        self.deliver(payload, None)
+        with self._condition:
+            # Measured from when this one was handled, since decrypting it can take a while.
+            self._last_arrival = time.monotonic()
+
+    def stop(self):
+        """Deliver whatever is still held; the broker already considers it delivered."""
+        with self._condition:
+            batch, self._pending = self._pending, []
+            self.active = False
+        if batch:
+            self._deliver_newest(batch)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self.active:
+                    self._condition.wait()
+
+                while len(self._pending) < self.max_pending:
+                    remaining = self._last_arrival + self.quiet_period - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+
+                batch, self._pending = self._pending, []
+                if not batch:
+                    # Messages arriving while a batch was delivered would be in `_pending`.
+                    self.active = False
+                    continue
+
+            self._deliver_newest(batch)
+
+    def _deliver_newest(self, batch):
+        seen = set()
+        newest = []
+        for payload in reversed(batch):
+            try:
+                itemid, fields = self.resolve_itemid(payload)
+            except Exception as e:
+                logger.warning("Decryption failed, ignoring message: %s", e)
+                continue
+            if itemid in seen:
+                continue
+            seen.add(itemid)
+            newest.append((payload, fields))
+
+        logger.info("Caught up on %d messages, showing %d", len(batch), len(newest))
+        for payload, fields in reversed(newest):
+            try:
+                self.deliver(payload, fields)
+            except Exception as e:
+                logger.error("Error processing message: %s", e)
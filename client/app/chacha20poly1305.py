@@ -0,0 +1,110 @@
+"""
+ChaCha20-Poly1305 decryption (RFC 8439) in pure Python, for payload format 2.
+
+The device has no native crypto library, and ChaCha20 only needs 32-bit additions,
+rotations and XORs, which makes it far cheaper than AES in pure Python.
+"""
+import hmac
+import struct
+
+_MASK32 = 0xFFFFFFFF
+_POLY1305_PRIME = (1 << 130) - 5
+_POLY1305_R_CLAMP = 0x0FFFFFFC0FFFFFFC0FFFFFFC0FFFFFFF
+
+
+def _chacha20_block(key_words, counter, nonce_words):
+    state = [0x61707865, 0x3320646E, 0x79622D32, 0x6B206574, *key_words, counter, *nonce_words]
+    x0, x1, x2, x3, x4, x5, x6, x7, x8, x9, x10, x11, x12, x13, x14, x15 = state
+
+    for _ in range(10):
+        # Column rounds
+        x0 = (x0 + x4) & _MASK32; x12 ^= x0; x12 = ((x12 << 16) | (x12 >> 16)) & _MASK32
+        x8 = (x8 + x12) & _MASK32; x4 ^= x8; x4 = ((x4 << 12) | (x4 >> 20)) & _MASK32
+        x0 = (x0 + x4) & _MASK32; x12 ^= x0; x12 = ((x12 << 8) | (x12 >> 24)) & _MASK32
+        x8 = (x8 + x12) & _MASK32; x4 ^= x8; x4 = ((x4 << 7) | (x4 >> 25)) & _MASK32
+
+        x1 = (x1 + x5) & _MASK32; x13 ^= x1; x13 = ((x13 << 16) | (x13 >> 16)) & _MASK32
+        x9 = (x9 + x13) & _MASK32; x5 ^= x9; x5 = ((x5 << 12) | (x5 >> 20)) & _MASK32
+        x1 = (x1 + x5) & _MASK32; x13 ^= x1; x13 = ((x13 << 8) | (x13 >> 24)) & _MASK32
+        x9 = (x9 + x13) & _MASK32; x5 ^= x9; x5 = ((x5 << 7) | (x5 >> 25)) & _MASK32
+
+        x2 = (x2 + x6) & _MASK32; x14 ^= x2; x14 = ((x14 << 16) | (x14 >> 16)) & _MASK32
+        x10 = (x10 + x14) & _MASK32; x6 ^= x10; x6 = ((x6 << 12) | (x6 >> 20)) & _MASK32
+        x2 = (x2 + x6) & _MASK32; x14 ^= x2; x14 = ((x14 << 8) | (x14 >> 24)) & _MASK32
+        x10 = (x10 + x14) & _MASK32; x6 ^= x10; x6 = ((x6 << 7) | (x6 >> 25)) & _MASK32
+
+        x3 = (x3 + x7) & _MASK32; x15 ^= x3; x15 = ((x15 << 16) | (x15 >> 16)) & _MASK32
+        x11 = (x11 + x15) & _MASK32; x7 ^= x11; x7 = ((x7 << 12) | (x7 >> 20)) & _MASK32
+        x3 = (x3 + x7) & _MASK32; x15 ^= x3; x15 = ((x15 << 8) | (x15 >> 24)) & _MASK32
+        x11 = (x11 + x15) & _MASK32; x7 ^= x11; x7 = ((x7 << 7) | (x7 >> 25)) & _MASK32
+
+        # Diagonal rounds
+        x0 = (x0 + x5) & _MASK32; x15 ^= x0; x15 = ((x15 << 16) | (x15 >> 16)) & _MASK32
+        x10 = (x10 + x15) & _MASK32; x5 ^= x10; x5 = ((x5 << 12) | (x5 >> 20)) & _MASK32
+        x0 = (x0 + x5) & _MASK32; x15 ^= x0; x15 = ((x15 << 8) | (x15 >> 24)) & _MASK32
+        x10 = (x10 + x15) & _MASK32; x5 ^= x10; x5 = ((x5 << 7) | (x5 >> 25)) & _MASK32
+
+        x1 = (x1 + x6) & _MASK32; x12 ^= x1; x12 = ((x12 << 16) | (x12 >> 16)) & _MASK32
+        x11 = (x11 + x12) & _MASK32; x6 ^= x11; x6 = ((x6 << 12) | (x6 >> 20)) & _MASK32
+        x1 = (x1 + x6) & _MASK32; x12 ^= x1; x12 = ((x12 << 8) | (x12 >> 24)) & _MASK32
+        x11 = (x11 + x12) & _MASK32; x6 ^= x11; x6 = ((x6 << 7) | (x6 >> 25)) & _MASK32
+
+        x2 = (x2 + x7) & _MASK32; x13 ^= x2; x13 = ((x13 << 16) | (x13 >> 16)) & _MASK32
+        x8 = (x8 + x13) & _MASK32; x7 ^= x8; x7 = ((x7 << 12) | (x7 >> 20)) & _MASK32
+        x2 = (x2 + x7) & _MASK32; x13 ^= x2; x13 = ((x13 << 8) | (x13 >> 24)) & _MASK32
+        x8 = (x8 + x13) & _MASK32; x7 ^= x8; x7 = ((x7 << 7) | (x7 >> 25)) & _MASK32
+
+        x3 = (x3 + x4) & _MASK32; x14 ^= x3; x14 = ((x14 << 16) | (x14 >> 16)) & _MASK32
+        x9 = (x9 + x14) & _MASK32; x4 ^= x9; x4 = ((x4 << 12) | (x4 >> 20)) & _MASK32
+        x3 = (x3 + x4) & _MASK32; x14 ^= x3; x14 = ((x14 << 8) | (x14 >> 24)) & _MASK32
+        x9 = (x9 + x14) & _MASK32; x4 ^= x9; x4 = ((x4 << 7) | (x4 >> 25)) & _MASK32
+
+    mixed = (x0, x1, x2, x3, x4, x5, x6, x7, x8, x9, x10, x11, x12, x13, x14, x15)
+    return struct.pack("<16L", *((a + b) & _MASK32 for a, b in zip(mixed, state)))
+
+
+def _chacha20_xor(key_words, nonce_words, counter, data):
+    out = bytearray()
+    for offset in range(0, len(data), 64):
+        chunk = data[offset:offset + 64]
+        keystream = _chacha20_block(key_words, counter, nonce_words)[:len(chunk)]
+        out += (int.from_bytes(chunk, "little") ^ int.from_bytes(keystream, "little")).to_bytes(len(chunk), "little")
+        counter += 1
+    return bytes(out)
+
+
+def _pad16(data):
+    return bytes(-len(data) % 16)
+
+
+def _poly1305(key, message):
+    r = int.from_bytes(key[:16], "little") & _POLY1305_R_CLAMP
+    s = int.from_bytes(key[16:32], "little")
+    accumulator = 0
+    for offset in range(0, len(message), 16):
+        block = int.from_bytes(message[offset:offset + 16] + b"\x01", "little")
+        accumulator = (accumulator + block) * r % _POLY1305_PRIME
+    return ((accumulator + s) & ((1 << 128) - 1)).to_bytes(16, "little")
+
+
+def decrypt(key: bytes, nonce: bytes, data: bytes, aad: bytes = b"") -> bytes:
+    """
+    Decrypt `data` (ciphertext followed by the 16-byte tag) with a 32-byte key and 12-byte nonce.
+    Raises ValueError if the tag does not match.
+    """
+    if len(key) != 32 or len(nonce) != 12 or len(data) < 16:
+        raise ValueError("Invalid ChaCha20-Poly1305 key, nonce or data length")
+
+    key_words = struct.unpack("<8L", key)
+    nonce_words = struct.unpack("<3L", nonce)
+    ciphertext, tag = data[:-16], data[-16:]
+
+    one_time_key = _chacha20_block(key_words, 0, nonce_words)[:32]
+    mac_data = (
+        aad + _pad16(aad) + ciphertext + _pad16(ciphertext)
+        + struct.pack("<QQ", len(aad), len(ciphertext))
+    )
+    if not hmac.compare_digest(_poly1305(one_time_key, mac_data), tag):
+        raise ValueError("ChaCha20-Poly1305 tag mismatch")
+
+    return _chacha20_xor(key_words, nonce_words, 1, ciphertext)
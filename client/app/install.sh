@@ -2,11 +2,20 @@
 BASEDIR="$(cd "$(dirname "$0")" && pwd)/../"
 
 SKIP_ROTATION=0
+IMPORT_KEYS=""
 # Parse args
-for arg in "$@"; do
-    if [ "$arg" = "--skip-rotation" ]; then
-        SKIP_ROTATION=1
-    fi
+while [ $# -gt 0 ]; do
+    case "$1" in
+        --skip-rotation)
+            SKIP_ROTATION=1
+            ;;
+        --import-keys)
+            # Keys generated off-device with app/keygen.py
+            IMPORT_KEYS="$2"
+            shift
+            ;;
+    esac
+    shift
 done
 
 # --- Step 1: Use binaries bundled in environment ---
@@ -34,10 +43,19 @@ else
     echo "UUID: $UUID"
 
     # --- Step 4: Generate keys and persist everything ---
-    echo "Generating notification encryption keys..."
+    # 1. Notification encryption key pair (server ➜ client)
+    # 2. Status signing key pair (client ➜ server)
+    KEYS_FILE="$PINGBERRY_ENV_DIR/app/.new_keys.json"
+    if [ -n "$IMPORT_KEYS" ]; then
+        echo "Importing encryption keys from $IMPORT_KEYS..."
+        $PYTHON_BIN "$PINGBERRY_ENV_DIR/app/keygen.py" --import "$IMPORT_KEYS" --output "$KEYS_FILE" || exit 1
+    else
+        echo "Generating encryption keys (this can take a few minutes)..."
+        $PYTHON_BIN "$PINGBERRY_ENV_DIR/app/keygen.py" --output "$KEYS_FILE" || exit 1
+    fi
+
     $PYTHON_BIN <<EOF
 import sys
-import rsa
 import json
 import requests
 from pathlib import Path
@@ -49,23 +67,15 @@ email = "$EMAIL"
 uuid_str = "$UUID"
 uuid_val = UUID(uuid_str)
 
-# --- Generate keys ---
-# 1. Notification encryption key pair (server ➜ client)
-notif_public_key, notif_private_key = rsa.newkeys(2048)
+# --- Load the generated or imported keys ---
+keys_path = Path("$KEYS_FILE")
+keys = json.loads(keys_path.read_text())
+keys_path.unlink()
 
-# 2. Status signing key pair (client ➜ server)
-status_public_key, status_private_key = rsa.newkeys(2048)
-
-# --- Serialize keys ---
 data = {
     "email": email,
     "uuid": str(uuid_val),
-
-    "notification_private_key": notif_private_key.save_pkcs1().decode(),
-    "notification_public_key": notif_public_key.save_pkcs1().decode(),
-
-    "status_private_key": status_private_key.save_pkcs1().decode(),
-    "status_public_key": status_public_key.save_pkcs1().decode()
+    **keys,
 }
 
 file_path = Path(basedir) / "app" / "client_data.json"
@@ -0,0 +1,152 @@
+"""
+Key generation for install.sh.
+
+Generates the notification and status key pairs at the same time in separate processes
+(each also searching for primes with rsa's `poolsize` where multiprocessing is available),
+and shows progress while it waits. Keys can also be generated on a computer with this same
+script and imported:
+
+    pip install rsa
+    python3 keygen.py --output pingberry-keys.json
+    # copy pingberry-keys.json to the device, then:
+    ./pingberry-env/install.sh --import-keys /path/to/pingberry-keys.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import rsa
+
+KEY_BITS = 2048
+KEY_NAMES = ("notification", "status")
+
+
+def _poolsize():
+    """Processes to search for primes with, per key pair. The device's runtime has no multiprocessing."""
+    try:
+        import multiprocessing  # noqa: F401
+    except ImportError:
+        return 1
+    return max(1, (os.cpu_count() or 1) // len(KEY_NAMES))
+
+
+def generate_private_key(bits=KEY_BITS) -> str:
+    _, private_key = rsa.newkeys(bits, poolsize=_poolsize())
+    return private_key.save_pkcs1().decode()
+
+
+def _key_entries(name, private_key_pem):
+    private_key = rsa.PrivateKey.load_pkcs1(private_key_pem.encode())
+    public_key = rsa.PublicKey(private_key.n, private_key.e)
+    return {
+        f"{name}_private_key": private_key_pem,
+        f"{name}_public_key": public_key.save_pkcs1().decode(),
+    }
+
+
+def _show_progress(start, done, total):
+    sys.stderr.write(f"\r  {int(time.monotonic() - start)}s elapsed, {done}/{total} key pairs ready ")
+    sys.stderr.flush()
+
+
+def generate_keys(bits=KEY_BITS, progress=True):
+    """Returns the PKCS#1 PEMs of both key pairs, as stored in client_data.json."""
+    start = time.monotonic()
+    pending = {}
+    try:
+        # One interpreter per key pair, so they run on separate cores.
+        for name in KEY_NAMES:
+            pending[name] = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "--private-key-only", "--bits", str(bits)],
+                stdout=subprocess.PIPE,
+            )
+    except OSError:
+        for process in pending.values():
+            process.kill()
+        pending = {}
+
+    keys = {}
+    try:
+        if not pending:
+            # Can't start processes: generate one after the other.
+            for index, name in enumerate(KEY_NAMES):
+                if progress:
+                    _show_progress(start, index, len(KEY_NAMES))
+                keys.update(_key_entries(name, generate_private_key(bits)))
+
+        while pending:
+            if progress:
+                _show_progress(start, len(KEY_NAMES) - len(pending), len(KEY_NAMES))
+            time.sleep(1)
+            for name, process in list(pending.items()):
+                if process.poll() is None:
+                    continue
+                del pending[name]
+                output = process.stdout.read().decode()
+                if process.returncode != 0 or not output:
+                    raise RuntimeError(f"Failed to generate {name} key")
+                keys.update(_key_entries(name, output))
+    finally:
+        for process in pending.values():
+            process.kill()
+
+    if progress:
+        _show_progress(start, len(KEY_NAMES), len(KEY_NAMES))
+        sys.stderr.write("\n")
+    return keys
+
+
+def import_keys(path, min_bits=KEY_BITS):
+    """Reads both private keys from a file written by --output (or a client_data.json)."""
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+
+    keys = {}
+    moduli = set()
+    for name in KEY_NAMES:
+        private_key_pem = data.get(f"{name}_private_key")
+        if not private_key_pem:
+            raise ValueError(f"{path} has no {name}_private_key")
+        private_key = rsa.PrivateKey.load_pkcs1(private_key_pem.encode())
+        if private_key.n.bit_length() < min_bits:
+            raise ValueError(f"The {name} key must be at least {min_bits} bits")
+        moduli.add(private_key.n)
+        keys.update(_key_entries(name, private_key_pem))
+
+    if len(moduli) != len(KEY_NAMES):
+        raise ValueError("The notification and status keys must be different")
+    return keys
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate or import PingBerry device keys")
+    parser.add_argument("--output", help="Where to write the keys (JSON)")
+    parser.add_argument("--import", dest="import_path", help="Import keys generated elsewhere instead")
+    parser.add_argument("--bits", type=int, default=KEY_BITS, help=f"RSA key size (default: {KEY_BITS})")
+    # Used by generate_keys for each of its processes
+    parser.add_argument("--private-key-only", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.private_key_only:
+        sys.stdout.write(generate_private_key(args.bits))
+        return
+    if not args.output:
+        parser.error("--output is required")
+
+    try:
+        keys = import_keys(args.import_path) if args.import_path else generate_keys(args.bits)
+    except (OSError, ValueError, RuntimeError) as e:
+        print(f"Key setup failed: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    # Private keys: readable by this user only.
+    fd = os.open(args.output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(keys, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
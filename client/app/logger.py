@@ -0,0 +1,68 @@
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+
+_listener = None
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps only `rate` of the per-message records (logged with extra={"sampled": True}) below WARNING."""
+
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if getattr(record, "sampled", False) and record.levelno < logging.WARNING:
+            return self.rate >= 1 or random.random() < self.rate
+        return True
+
+
+def setup_logging(config):
+    """
+    Configure logging from the credentials file. Records are written by one background
+    thread, so paho's network thread never waits on the console or flash storage.
+
+    Optional keys: LOG_LEVEL (default INFO), LOG_SAMPLE_RATE (0-1, default 1), and
+    LOG_FILE (default: standard output).
+    """
+    global _listener
+
+    log_file = config.get("LOG_FILE")
+    handler = logging.FileHandler(log_file, encoding="utf-8") if log_file else logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+
+    # A typo in the credentials file falls back to the default rather than stopping notifications.
+    problems = []
+    try:
+        sample_rate = float(config.get("LOG_SAMPLE_RATE", 1))
+    except (TypeError, ValueError):
+        problems.append(f"Invalid LOG_SAMPLE_RATE ({config['LOG_SAMPLE_RATE']!r}); using 1")
+        sample_rate = 1.0
+    level = logging.getLevelName(str(config.get("LOG_LEVEL", "INFO")).upper())
+    if not isinstance(level, int):
+        # getLevelName returns "Level FOO" for names it doesn't know.
+        problems.append(f"Unknown LOG_LEVEL ({config['LOG_LEVEL']!r}); using INFO")
+        level = logging.INFO
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_rate))
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, handler)
+    _listener.start()
+    for problem in problems:
+        logging.getLogger("logger").warning(problem)
+
+
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,111 @@
+import fcntl
+import json
+import logging
+import os
+import queue
+import threading
+
+CONTROL_PATH = "/pps/services/notify/control"
+
+logger = logging.getLogger("pps_writer")
+
+
+def format_notification(itemid, title, subtitle, target, target_action, payload_field, payload_type, payload_uri) -> bytes:
+    """
+    Build the notify command for the PPS control file.
+    Builds JSON for the `dat` field to avoid shell injection.
+    """
+    dat = {
+        "itemid": itemid,
+        "title": title,
+        "subtitle": subtitle,
+        "target": target,
+        "targetAction": target_action,
+        "payload": payload_field,
+        "payloadType": payload_type,
+        "payloadURI": payload_uri
+    }
+    dat_json = json.dumps(dat, separators=(",", ":"), ensure_ascii=False)
+    return f"msg::notify\ndat:json:{dat_json}\n".encode("utf-8")
+
+
+class PPSWriter:
+    """
+    One long-lived thread that writes notifications to the PPS control file, so a burst of
+    messages after a reconnect doesn't start a thread per message.
+
+    The control file stays open. Whatever is queued is written under a single flock and fsync,
+    but still with one write() per notification, since PPS treats each write as one message.
+    When the queue is full, submit() waits, which slows paho down instead of dropping notifications.
+    """
+
+    def __init__(self, control_path=CONTROL_PATH, max_queue=256, max_batch=32, submit_timeout=10.0):
+        self.control_path = control_path
+        self.max_batch = max_batch
+        self.submit_timeout = submit_timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._fd = None
+        self._thread = threading.Thread(target=self._run, name="pps-writer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def submit(self, itemid, title, subtitle, target, target_action, payload_field, payload_type, payload_uri):
+        message = format_notification(
+            itemid, title, subtitle, target, target_action, payload_field, payload_type, payload_uri
+        )
+        try:
+            self._queue.put(message, timeout=self.submit_timeout)
+        except queue.Full:
+            logger.error("PPS writer is stuck; dropping notification")
+
+    def stop(self, timeout=5.0):
+        """Write out what is queued, then close the control file."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while batch[-1] is not None and len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = batch[-1] is None
+            messages = [message for message in batch if message is not None]
+            if messages:
+                self._write(messages)
+            if stopping:
+                self._close()
+                return
+
+    def _write(self, messages):
+        try:
+            if self._fd is None:
+                self._fd = os.open(self.control_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+
+            # Lock is held for the whole batch
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                for message in messages:
+                    os.write(self._fd, message)
+                os.fsync(self._fd)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+            logger.debug("Wrote %d notification(s) to PPS", len(messages))
+        except OSError as e:
+            logger.error("Failed to write %d notify message(s): %s", len(messages), e)
+            # Reopen on the next batch, in case the PPS object went away.
+            self._close()
+
+    def _close(self):
+        if self._fd is not None:
+            try:
+                os.close(self._fd)
+            except OSError:
+                pass
+            self._fd = None
@@ -0,0 +1,107 @@
+"""
+RSA (PKCS#1 v1.5) decryption with the notification private key, tuned for the device.
+
+The `rsa` package already uses the Chinese Remainder Theorem, but every call also pays for
+re-blinding: a full public-exponent exponentiation modulo n. Here the CRT parameters and
+a blinding pair (r^e, r^-1) are prepared once at startup, and each message moves to the next
+blinding pair by squaring both, which costs two multiplications instead.
+
+The `rsa` package is only imported once a key is loaded, so importing this module stays cheap.
+"""
+import hmac
+import logging
+import math
+import secrets
+import threading
+
+logger = logging.getLogger("rsa_decrypt")
+
+
+def _decryption_error():
+    import rsa
+    return rsa.DecryptionError("Decryption failed")
+
+
+class Decryptor:
+    def __init__(self, private_key: "rsa.PrivateKey"):
+        self.n = private_key.n
+        self.p = private_key.p
+        self.q = private_key.q
+        self.dp = private_key.exp1
+        self.dq = private_key.exp2
+        self.q_inverse = private_key.coef
+        self.block_size = (self.n.bit_length() + 7) // 8
+
+        while True:
+            r = secrets.randbelow(self.n - 2) + 2
+            if math.gcd(r, self.n) == 1:
+                break
+        self._blinding = pow(r, private_key.e, self.n)
+        self._unblinding = pow(r, -1, self.n)
+        self._lock = threading.Lock()
+
+    def _next_blinding_pair(self):
+        with self._lock:
+            self._blinding = self._blinding * self._blinding % self.n
+            self._unblinding = self._unblinding * self._unblinding % self.n
+            return self._blinding, self._unblinding
+
+    def decrypt_int(self, encrypted: int) -> int:
+        blinding, unblinding = self._next_blinding_pair()
+        blinded = encrypted * blinding % self.n
+
+        s1 = pow(blinded, self.dp, self.p)
+        s2 = pow(blinded, self.dq, self.q)
+        h = (s1 - s2) * self.q_inverse % self.p
+        return (s2 + self.q * h) * unblinding % self.n
+
+    def decrypt(self, ciphertext: bytes) -> bytes:
+        """Same result as rsa.decrypt(ciphertext, private_key). Raises rsa.DecryptionError on failure."""
+        if len(ciphertext) > self.block_size:
+            raise _decryption_error()
+
+        cleartext = self.decrypt_int(int.from_bytes(ciphertext, "big")).to_bytes(self.block_size, "big")
+
+        # As in rsa.pkcs1.decrypt: check the 00 02 marker and at least 8 bytes of padding
+        # without saying which check failed.
+        marker_bad = not hmac.compare_digest(cleartext[:2], b"\x00\x02")
+        separator = cleartext.find(b"\x00", 2)
+        if marker_bad | (separator < 10):
+            raise _decryption_error()
+        return cleartext[separator + 1:]
+
+
+class BackgroundDecryptor:
+    """
+    Parses a PKCS#1 PEM private key and prepares its Decryptor on a thread, so startup can
+    connect in the meantime. decrypt() waits until it is ready.
+    """
+
+    def __init__(self, private_key_pem: str, on_ready=None):
+        self._decryptor = None
+        self._error = None
+        self._ready = threading.Event()
+        threading.Thread(
+            target=self._load, args=(private_key_pem, on_ready), name="key-loader", daemon=True
+        ).start()
+
+    def _load(self, private_key_pem, on_ready):
+        try:
+            import rsa
+            self._decryptor = Decryptor(rsa.PrivateKey.load_pkcs1(private_key_pem.encode()))
+        except Exception as e:
+            logger.error("Failed to load the notification key: %s", e)
+            self._error = e
+        finally:
+            self._ready.set()
+            if on_ready is not None:
+                on_ready()
+
+    def get(self) -> Decryptor:
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+        return self._decryptor
+
+    def decrypt(self, ciphertext: bytes) -> bytes:
+        return self.get().decrypt(ciphertext)
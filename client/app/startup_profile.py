@@ -0,0 +1,116 @@
+"""
+Startup instrumentation for `subscriber.py --profile-startup`.
+
+Records when each startup event happens and how long every import takes (like
+`python -X importtime`), then writes a report to stderr once the subscription is acknowledged.
+Disabled, every call is a no-op.
+"""
+import sys
+import time
+
+
+class _TimedLoader:
+    def __init__(self, loader, timer):
+        self._loader = loader
+        self._timer = timer
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        self._timer.enter()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            self._timer.exit(module.__name__)
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+
+class ImportTimer:
+    """A meta path finder that times each module's execution, with and without its own imports."""
+
+    def __init__(self):
+        self.records = []  # (module, self seconds, cumulative seconds, depth), in completion order
+        self._stack = []  # [start, seconds spent in nested imports]
+
+    def find_spec(self, name, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                    spec.loader = _TimedLoader(spec.loader, self)
+                return spec
+        return None
+
+    def enter(self):
+        self._stack.append([time.perf_counter(), 0.0])
+
+    def exit(self, name):
+        start, nested = self._stack.pop()
+        cumulative = time.perf_counter() - start
+        if self._stack:
+            self._stack[-1][1] += cumulative
+        self.records.append((name, cumulative - nested, cumulative, len(self._stack)))
+
+
+class StartupProfile:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.events = {"start": time.perf_counter()}
+        self.imports = None
+        if enabled:
+            self.imports = ImportTimer()
+            sys.meta_path.insert(0, self.imports)
+
+    def mark(self, event):
+        """Record that `event` happened now (the first time only)."""
+        if self.enabled:
+            self.events.setdefault(event, time.perf_counter())
+
+    def ssl_context(self, context):
+        """Make `context` mark "tls started" and "tls done" around its handshakes."""
+        if not self.enabled:
+            return context
+
+        profile = self
+
+        class TimedSSLSocket(context.sslsocket_class):
+            def do_handshake(self, *args, **kwargs):
+                profile.mark("tls started")
+                result = super().do_handshake(*args, **kwargs)
+                profile.mark("tls done")
+                return result
+
+        context.sslsocket_class = TimedSSLSocket
+        return context
+
+    def report(self, phases, min_import_seconds=0.001):
+        """Write the phases, as (label, start event, end event), and the slower imports to stderr."""
+        if not self.enabled or self.imports is None:
+            return
+        sys.meta_path.remove(self.imports)
+
+        start = self.events["start"]
+        lines = ["Startup profile (ms since subscriber.py started):"]
+        for label, start_event, end_event in phases:
+            if start_event in self.events and end_event in self.events:
+                began = self.events[start_event]
+                lines.append(
+                    f"  {label:<32} at {(began - start) * 1000:8.1f}  took {(self.events[end_event] - began) * 1000:8.1f}"
+                )
+            else:
+                lines.append(f"  {label:<32} (not reached)")
+
+        lines.append(f"Imports taking at least {min_import_seconds * 1000:g} ms:")
+        lines.append("import time: self [us] | cumulative | imported package")
+        for name, own, cumulative, depth in self.imports.records:
+            if cumulative >= min_import_seconds:
+                lines.append(f"import time: {own * 1e6:9.0f} | {cumulative * 1e6:10.0f} | {'  ' * depth}{name}")
+
+        sys.stderr.write("\n".join(lines) + "\n")
+        sys.stderr.flush()
+        self.imports = None
@@ -1,26 +1,54 @@
+import sys
+from startup_profile import StartupProfile
+
+# Created before the other imports so --profile-startup can time them.
+startup = StartupProfile(enabled="--profile-startup" in sys.argv)
+
 import paho.mqtt.client as mqtt
 import ssl
-import time
 import json
-import threading
-import uuid
+import hashlib
 import argparse
 from pathlib import Path
-import rsa
 import base64
-import fcntl
-import os
+import logging
+from collections import OrderedDict
+import chacha20poly1305
+from rsa_decrypt import BackgroundDecryptor, Decryptor
+from pps_writer import PPSWriter
+from catch_up import CatchUp
+from logger import setup_logging, stop_logging
 
 SESSION_EXPIRY_30_DAYS = 30 * 24 * 60 * 60
 
-# --------- Utilities ---------
-def log(msg):
-    print(msg)
+# Notification payload formats this client can decrypt, advertised in its status.
+# 1: each field RSA-encrypted. 2: one RSA-wrapped ChaCha20-Poly1305 key for the whole notification.
+# 3: like 2, with a session key reused across notifications (used only if the server enables it).
+PAYLOAD_FORMATS = [1, 2, 3]
+
+# Unwrapped format 3 session keys by key id. The server may hold one per encryption worker.
+SESSION_KEY_CACHE_SIZE = 16
+session_keys = OrderedDict()
+
+# Reported by --profile-startup: (label, start event, end event)
+STARTUP_PHASES = (
+    ("imports", "start", "imported"),
+    ("config and signed statuses", "imported", "statuses ready"),
+    ("notification key (in parallel)", "key load started", "key loaded"),
+    ("TCP connect", "connecting", "tls started"),
+    ("TLS handshake", "tls started", "tls done"),
+    ("websocket upgrade and CONNECT", "tls done", "connect sent"),
+    ("CONNACK", "connect sent", "connack"),
+    ("SUBACK", "subscribe sent", "suback"),
+)
+
+logger = logging.getLogger("subscriber")
 
+# --------- Utilities ---------
 def load_client_data(path):
     path = Path(path)
     if not path.exists():
-        log(f"Client data file not found: {path}")
+        logger.error("Client data file not found: %s", path)
         exit(1)
     data = json.loads(path.read_text(encoding="utf-8"))
     return data
@@ -28,124 +56,190 @@ def load_client_data(path):
 def load_credentials(path):
     path = Path(path)
     if not path.exists():
-        log(f"MQTT credentials file not found: {path}")
+        logger.error("MQTT credentials file not found: %s", path)
         exit(1)
     data = json.loads(path.read_text(encoding="utf-8"))
     return data
 
-def load_keys(client_data):
-    notif_priv_key = rsa.PrivateKey.load_pkcs1(client_data["notification_private_key"].encode())
-    status_priv_key = rsa.PrivateKey.load_pkcs1(client_data["status_private_key"].encode())
-    return notif_priv_key, status_priv_key
-
-def decrypt_payload(encrypted_b64: str, private_key: rsa.PrivateKey) -> str:
+def decrypt_payload(encrypted_b64: str, decryptor: Decryptor) -> str:
     """
     Decrypts a base64-encoded RSA-encrypted payload. Raises on failure.
     """
     ciphertext = base64.b64decode(encrypted_b64)
-    decrypted = rsa.decrypt(ciphertext, private_key)
+    decrypted = decryptor.decrypt(ciphertext)
     return decrypted.decode()
 
-def safe_send_notification(itemid, title, subtitle, target, target_action,
-                           payload_field, payload_type, payload_uri,
-                           control_path="/pps/services/notify/control"):
+def decrypt_hybrid_payload(payload_data: dict, decryptor: Decryptor) -> dict:
     """
-    Safely write the notification command to the PPS control file using an exclusive file lock.
-    Builds JSON for the `dat` field to avoid shell injection.
+    Decrypts a format 2 payload into its itemid, title and subtitle. Raises on failure.
     """
-    msg = {
-        "msg": "notify",
-        "dat": {
-            "itemid": itemid,
-            "title": title,
-            "subtitle": subtitle,
-            "target": target,
-            "targetAction": target_action,
-            "payload": payload_field,
-            "payloadType": payload_type,
-            "payloadURI": payload_uri
-        }
-    }
-
-    dat_json = json.dumps(msg["dat"], separators=(",", ":"), ensure_ascii=False)
-    full_message = f"msg::notify\ndat:json:{dat_json}\n"
+    key = decryptor.decrypt(base64.b64decode(payload_data["key"]))
+    plaintext = chacha20poly1305.decrypt(
+        key, base64.b64decode(payload_data["nonce"]), base64.b64decode(payload_data["data"])
+    )
+    return json.loads(plaintext.decode())
 
-    try:
-        with open("/pps/services/notify/control", "a", encoding="utf-8") as f:
-            # Acquire exclusive lock while writing
-            fcntl.flock(f, fcntl.LOCK_EX)
-            f.write(full_message)
-            f.flush()
-            os.fsync(f.fileno())
-            # Lock is released when file is closed
-    except Exception as e:
-        log(f"Failed to write notify message: {e}")
+def decrypt_session_payload(payload_data: dict, decryptor: Decryptor) -> dict:
+    """
+    Decrypts a format 3 payload. Only a session key not seen before costs an RSA decryption.
+    Raises on failure.
+    """
+    key_id = payload_data["kid"]
+    key = session_keys.get(key_id)
+    cached = key is not None
+    if not cached:
+        key = decryptor.decrypt(base64.b64decode(payload_data["key"]))
+
+    plaintext = chacha20poly1305.decrypt(
+        key, base64.b64decode(payload_data["nonce"]), base64.b64decode(payload_data["data"]), key_id.encode()
+    )
 
-def make_signed_status_payload(status: bool, private_key: rsa.PrivateKey) -> str:
-    payload = json.dumps({"status": status})
+    # Only remember keys that decrypted a message.
+    if cached:
+        session_keys.move_to_end(key_id)
+    else:
+        session_keys[key_id] = key
+        while len(session_keys) > SESSION_KEY_CACHE_SIZE:
+            session_keys.popitem(last=False)
+    return json.loads(plaintext.decode())
+
+def make_status_payload(status: bool) -> str:
+    return json.dumps({"status": status, "formats": PAYLOAD_FORMATS})
+
+def make_signed_status_payload(status: bool, private_key) -> str:
+    import rsa
+    payload = make_status_payload(status)
     signature = rsa.sign(payload.encode(), private_key, 'SHA-256')
     return json.dumps({
         "payload": payload,
         "signature": base64.b64encode(signature).decode()
     })
 
+def load_signed_statuses(client_data, cache_path):
+    """
+    Signed online and offline status payloads. Signatures are deterministic, so they are cached
+    next to client_data.json, and the status key is only parsed and used when it or the payloads change.
+    """
+    key_hash = hashlib.sha256(client_data["status_public_key"].encode()).hexdigest()
+    try:
+        cache = json.loads(Path(cache_path).read_text(encoding="utf-8"))
+        signed = {True: cache["online"], False: cache["offline"]}
+        if cache["status_public_key_sha256"] == key_hash and all(
+            json.loads(signed[status])["payload"] == make_status_payload(status) for status in signed
+        ):
+            return signed
+    except (OSError, ValueError, KeyError):
+        pass
+
+    import rsa
+    status_private_key = rsa.PrivateKey.load_pkcs1(client_data["status_private_key"].encode())
+    signed = {status: make_signed_status_payload(status, status_private_key) for status in (True, False)}
+    try:
+        Path(cache_path).write_text(json.dumps({
+            "status_public_key_sha256": key_hash,
+            "online": signed[True],
+            "offline": signed[False],
+        }), encoding="utf-8")
+    except OSError as e:
+        logger.warning("Could not cache signed statuses: %s", e)
+    return signed
+
 def on_connect(client, userdata, flags, reasonCode, properties):
-    log(f"Connected: {reasonCode}")
-    log(f"Subscribing to: {userdata['topic']}")
+    startup.mark("connack")
+    logger.info("Connected: %s", reasonCode)
+    # Queued notifications arrive right after connecting; collapse them before showing any.
+    userdata["catch_up"].arm()
+
+    logger.info("Subscribing to: %s", userdata['topic'])
+    startup.mark("subscribe sent")
     client.subscribe(userdata['topic'], qos=1)
 
     client.publish(
         topic=userdata['status_topic'],
-        payload=make_signed_status_payload(True, userdata['status_pk']),
+        payload=userdata['online_status'],
         qos=1,
         retain=True
     )
 
+def on_subscribe(client, userdata, mid, reason_code_list, properties):
+    startup.mark("suback")
+    startup.report(STARTUP_PHASES)
+
 def on_disconnect(client, userdata, flags, reasonCode, properties):
-    log(f"Disconnected: {reasonCode}")
+    logger.warning("Disconnected: %s", reasonCode)
+
+def decrypt_itemid(payload_data: dict, decryptor: Decryptor):
+    """
+    Decrypts as little as possible to learn a notification's itemid.
+    Returns (itemid, the fields decrypted so far). Raises on failure.
+    """
+    if payload_data.get("v") == 3:
+        notification = decrypt_session_payload(payload_data, decryptor)
+        return notification["itemid"], notification
+    if payload_data.get("v") == 2:
+        notification = decrypt_hybrid_payload(payload_data, decryptor)
+        return notification["itemid"], notification
+
+    # Required encrypted fields
+    encrypted_itemid = payload_data.get("itemid")
+    encrypted_title = payload_data.get("title")
+    if not all([encrypted_itemid, encrypted_title, payload_data.get("subtitle")]):
+        raise ValueError("Missing required encrypted fields")
+
+    # With collapse_duplicates the server reuses the title ciphertext as the itemid.
+    if encrypted_itemid == encrypted_title:
+        title = decrypt_payload(encrypted_title, decryptor)
+        return title, {"itemid": title, "title": title}
+    itemid = decrypt_payload(encrypted_itemid, decryptor)
+    return itemid, {"itemid": itemid}
+
+def decrypt_notification(payload_data: dict, decryptor: Decryptor, fields: dict = None) -> dict:
+    """
+    Decrypts a notification's itemid, title and subtitle, reusing any `fields` already decrypted.
+    Raises on failure.
+    """
+    if fields is None:
+        _, fields = decrypt_itemid(payload_data, decryptor)
+    if "title" not in fields:
+        fields["title"] = decrypt_payload(payload_data["title"], decryptor)
+    if "subtitle" not in fields:
+        fields["subtitle"] = decrypt_payload(payload_data["subtitle"], decryptor)
+    return fields
+
+def deliver_notification(payload_data: dict, userdata: dict, fields: dict = None):
+    # If any field fails to decrypt, ignore the message completely
+    try:
+        notification = decrypt_notification(payload_data, userdata["notif_decryptor"], fields)
+    except Exception as e:
+        logger.warning("Decryption failed, ignoring message: %s", e)
+        return
+
+    # Other (non-encrypted) metadata
+    target = payload_data.get("target", "defaultTarget")
+    target_action = payload_data.get("targetAction", "defaultTargetAction")
+    payload_field = payload_data.get("payload", "defaultPayload")
+    payload_type = payload_data.get("payloadType", "defaultPayloadType")
+    payload_uri = payload_data.get("payloadURI", "defaultPayloadURI")
+
+    # Hand off to the PPS writer thread
+    userdata["pps_writer"].submit(
+        notification["itemid"], notification["title"], notification["subtitle"],
+        target, target_action, payload_field, payload_type, payload_uri
+    )
 
 def on_message(client, userdata, msg):
-    log(f"Received message on {msg.topic}")
-    notif_private_key = userdata["notif_pk"]
+    logger.debug("Received message on %s", msg.topic, extra={"sampled": True})
 
     try:
         payload_data = json.loads(msg.payload.decode())
-
-        # Required encrypted fields
-        encrypted_itemid = payload_data.get("itemid")
-        encrypted_title = payload_data.get("title")
-        encrypted_subtitle = payload_data.get("subtitle")
-
-        if not all([encrypted_itemid, encrypted_title, encrypted_subtitle]):
-            log("Missing required encrypted fields; ignoring message.")
-            return
-
-        # Try to decrypt all payloads; if any fail, ignore message completely
-        try:
-            itemid = decrypt_payload(encrypted_itemid, notif_private_key)
-            title = decrypt_payload(encrypted_title, notif_private_key)
-            subtitle = decrypt_payload(encrypted_subtitle, notif_private_key)
-        except Exception as e:
-            log(f"Decryption failed, ignoring message: {e}")
-            return
-
-        # Other (non-encrypted) metadata
-        target = payload_data.get("target", "defaultTarget")
-        target_action = payload_data.get("targetAction", "defaultTargetAction")
-        payload_field = payload_data.get("payload", "defaultPayload")
-        payload_type = payload_data.get("payloadType", "defaultPayloadType")
-        payload_uri = payload_data.get("payloadURI", "defaultPayloadURI")
-
-        # Send to PPS safely in a background thread
-        threading.Thread(
-            target=safe_send_notification,
-            args=(itemid, title, subtitle, target, target_action, payload_field, payload_type, payload_uri)
-        ).start()
+        # Delivered now, or held with the rest of a burst and collapsed by itemid
+        userdata["catch_up"].submit(payload_data)
 
     except Exception as e:
-        log(f"Error processing message: {e}")
+        logger.error("Error processing message: %s", e)
 
 def main():
+    startup.mark("imported")
     parser = argparse.ArgumentParser(description="MQTT Notification Subscriber")
     parser.add_argument(
         "--client-data",
@@ -159,9 +253,16 @@ def main():
         help="Path to MQTT credentials JSON file (default: mqtt_credentials.json)"
     )
 
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="Print startup phase and import timings to stderr once subscribed"
+    )
+
     args = parser.parse_args()
 
     creds = load_credentials(args.mqtt_credentials)
+    setup_logging(creds)
     MQTT_BROKER = creds["MQTT_BROKER"]
     MQTT_PORT = creds["MQTT_PORT"]
     MQTT_USERNAME = creds["MQTT_USERNAME"]
@@ -169,7 +270,14 @@ def main():
 
     client_data = load_client_data(args.client_data)
     uuid_str = client_data["uuid"]
-    notif_private_key, status_private_key = load_keys(client_data)
+
+    # Parsing the notification key overlaps with connecting; messages wait for it if they must.
+    startup.mark("key load started")
+    notif_decryptor = BackgroundDecryptor(
+        client_data["notification_private_key"], on_ready=lambda: startup.mark("key loaded")
+    )
+    signed_statuses = load_signed_statuses(client_data, Path(args.client_data).with_name("signed_statuses.json"))
+    startup.mark("statuses ready")
 
     notification_topic = f"notifications/{uuid_str}"
     status_topic = f"status/{uuid_str}"
@@ -181,33 +289,54 @@ def main():
         client_id=uuid_str
     )
 
-    mqtt_client.tls_set()
+    # Same settings as tls_set(): system CA certificates, hostname checked.
+    mqtt_client.tls_set_context(startup.ssl_context(ssl.create_default_context()))
     mqtt_client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
 
     mqtt_client.will_set(
         topic=status_topic,
-        payload=make_signed_status_payload(False, status_private_key),
+        payload=signed_statuses[False],
         qos=1,
         retain=True
     )
 
-    mqtt_client.user_data_set({
+    pps_writer = PPSWriter()
+    pps_writer.start()
+
+    userdata = {
         "uuid": uuid_str,
         "topic": notification_topic,
         "status_topic": status_topic,
-        "notif_pk": notif_private_key,
-        "status_pk": status_private_key
-    })
+        # CRT parameters and blinding prepared once, rather than on every message.
+        "notif_decryptor": notif_decryptor,
+        "pps_writer": pps_writer,
+        "online_status": signed_statuses[True]
+    }
+    catch_up = CatchUp(
+        resolve_itemid=lambda payload_data: decrypt_itemid(payload_data, userdata["notif_decryptor"]),
+        deliver=lambda payload_data, fields: deliver_notification(payload_data, userdata, fields),
+    )
+    catch_up.start()
+    userdata["catch_up"] = catch_up
+    mqtt_client.user_data_set(userdata)
 
     mqtt_client.on_connect = on_connect
     mqtt_client.on_disconnect = on_disconnect
     mqtt_client.on_message = on_message
+    mqtt_client.on_subscribe = on_subscribe
 
     connect_properties = mqtt.Properties(mqtt.PacketTypes.CONNECT)
     connect_properties.SessionExpiryInterval = SESSION_EXPIRY_30_DAYS
 
+    startup.mark("connecting")
     mqtt_client.connect(MQTT_BROKER, MQTT_PORT, keepalive=30, properties=connect_properties, clean_start=False)
-    mqtt_client.loop_forever()
+    startup.mark("connect sent")
+    try:
+        mqtt_client.loop_forever()
+    finally:
+        catch_up.stop()
+        pps_writer.stop()
+        stop_logging()
 
 if __name__ == "__main__":
     main()
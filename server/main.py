@@ -1,51 +1,72 @@
 from fastapi import FastAPI, BackgroundTasks, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from models import NotificationRequest, RegisterRequest, PublicKeyRequest, PublicKeyResponse, EncryptedNotificationRequest
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import NotificationRequest, BatchNotificationRequest, RegisterRequest, PublicKeyRequest, PublicKeyResponse, EncryptedNotificationRequest
 from notifications.notification_service import NotificationService
 from schemas import Client, Base
 from db import SessionLocal, engine
 from dotenv import load_dotenv
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from util.validate import Validate
+from util.metrics import REGISTRY
+from util.logger import setup_logging, stop_logging
+from notifications.metrics import NOTIFY_SECONDS, NOTIFICATION_RESULTS
+from contextlib import asynccontextmanager
 import os
 import time
 
 load_dotenv()
 
+setup_logging(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    fmt=os.getenv("LOG_FORMAT", "text"),
+    sample_rate=float(os.getenv("LOG_SAMPLE_RATE", "1")),
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create tables
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    await notifier.start()
+    yield
+    await notifier.close()
+    await engine.dispose()
+    stop_logging()
+
 start_time = time.time()
 app = FastAPI(
     docs_url=None,
     redoc_url=None,
     openapi_url=None,
+    lifespan=lifespan,
 )
 
-notifier = NotificationService(db_path=os.getenv("DB_PATH", "notification.db"))
-
-# Create tables
-Base.metadata.create_all(bind=engine)
+notifier = NotificationService(SessionLocal)
 
 # Dependency to get DB session
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 @app.post("/notify")
 async def send_notification(request: NotificationRequest):
     # Validate each field separately for clear error messages
-    Validate.check_field_length(request.message_title, "message_title")
-    Validate.check_field_length(request.message_body, "message_body")
+    # Devices that only accept payload format 1 get the tighter limit when the payload is built.
+    Validate.check_field_length(request.message_title, "message_title", Validate.MAX_HYBRID_FIELD_SIZE)
+    Validate.check_field_length(request.message_body, "message_body", Validate.MAX_HYBRID_FIELD_SIZE)
 
     # Continue with notification sending
-    result = await notifier.send_notification(
-        request.recipient_email,
-        request.message_title,
-        request.message_body,
-        request.queue_if_offline,
-        request.collapse_duplicates,
-    )
+    with NOTIFY_SECONDS.time(endpoint="notify"):
+        result = await notifier.send_notification(
+            request.recipient_email,
+            request.message_title,
+            request.message_body,
+            request.queue_if_offline,
+            request.collapse_duplicates,
+        )
+    NOTIFICATION_RESULTS.inc(endpoint="notify", code=result["code"])
 
     if result["status"] == "success":
         return JSONResponse(
@@ -64,19 +85,65 @@ async def send_notification(request: NotificationRequest):
         status_code=result["code"],
     )
 
+@app.post("/notify/batch")
+async def send_batch_notification(request: BatchNotificationRequest):
+    """
+    Send the same notification to many registered recipients in one request.
+    Always returns 200; each recipient has its own result and status code.
+    """
+    Validate.check_batch_size(request.recipient_emails, "recipient_emails")
+    # Devices that only accept payload format 1 get the tighter limit when the payload is built.
+    Validate.check_field_length(request.message_title, "message_title", Validate.MAX_HYBRID_FIELD_SIZE)
+    Validate.check_field_length(request.message_body, "message_body", Validate.MAX_HYBRID_FIELD_SIZE)
+
+    with NOTIFY_SECONDS.time(endpoint="notify_batch"):
+        results = await notifier.send_batch_notification(
+            request.recipient_emails,
+            request.message_title,
+            request.message_body,
+            request.queue_if_offline,
+            request.collapse_duplicates,
+        )
+    for result in results:
+        NOTIFICATION_RESULTS.inc(endpoint="notify_batch", code=result["code"])
+
+    return JSONResponse(
+        content={
+            "message": "Batch processed",
+            "sent": sum(1 for result in results if result["status"] == "success"),
+            "failed": sum(1 for result in results if result["status"] != "success"),
+            "results": results,
+        },
+        status_code=status.HTTP_200_OK,
+    )
+
 @app.post("/notify/encrypted")
 async def send_encrypted_notification(request: EncryptedNotificationRequest):
     """
     Send an encrypted notification to a registered client device.
-    The title and body must be pre-encrypted by the sender.
+    The sender provides either an RSA-encrypted title and body, or a whole format 2 payload.
     """
-    result = await notifier.send_encrypted_notification(
-        request.recipient_email,
-        request.encrypted_title,
-        request.encrypted_body,
-        request.queue_if_offline,
-        request.collapse_duplicates,
-    )
+    if request.encrypted_payload is not None:
+        Validate.check_encrypted_payload(request.encrypted_payload, "encrypted_payload")
+    elif request.encrypted_title is None or request.encrypted_body is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail={
+                "error": "Missing encrypted content",
+                "requirements": "Provide 'encrypted_title' and 'encrypted_body', or 'encrypted_payload'",
+            },
+        )
+
+    with NOTIFY_SECONDS.time(endpoint="notify_encrypted"):
+        result = await notifier.send_encrypted_notification(
+            request.recipient_email,
+            request.encrypted_title,
+            request.encrypted_body,
+            request.queue_if_offline,
+            request.collapse_duplicates,
+            request.encrypted_payload,
+        )
+    NOTIFICATION_RESULTS.inc(endpoint="notify_encrypted", code=result["code"])
 
     if result["status"] == "success":
         return JSONResponse(
@@ -96,9 +163,9 @@ async def send_encrypted_notification(request: EncryptedNotificationRequest):
     )
 
 @app.post("/register")
-def register(request: RegisterRequest, db: Session = Depends(get_db)):
-    existing_by_uuid = db.query(Client).filter_by(uuid=str(request.uuid)).first()
-    existing_by_email = db.query(Client).filter_by(email=request.email).first()
+async def register(request: RegisterRequest, db: AsyncSession = Depends(get_db)):
+    existing_by_uuid = await db.scalar(select(Client).filter_by(uuid=str(request.uuid)))
+    existing_by_email = await db.scalar(select(Client).filter_by(email=request.email))
 
     # TODO in the future, key rotation could be allowed only if we can verify the client to prevent hijacking (e.g., sending a link via email).
     if existing_by_uuid:
@@ -121,8 +188,14 @@ def register(request: RegisterRequest, db: Session = Depends(get_db)):
         status_public_key=request.status_public_key,
     )
     db.add(client)
-    db.commit()
-    db.refresh(client)
+    await db.commit()
+
+    notifier.client_registered(
+        client.uuid,
+        client.email,
+        client.notification_public_key,
+        client.status_public_key,
+    )
 
     return JSONResponse(
         content={"message": "Client registered successfully"},
@@ -130,26 +203,36 @@ def register(request: RegisterRequest, db: Session = Depends(get_db)):
     )
 
 @app.post("/clients/public-key", response_model=PublicKeyResponse)
-def get_public_key(request: PublicKeyRequest, db: Session = Depends(get_db)):
-    client = db.query(Client).filter_by(email=request.recipient_email).first()
+async def get_public_key(request: PublicKeyRequest):
+    client = await notifier.get_client_info(request.recipient_email)
     if not client:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Client not found"
         )
     return PublicKeyResponse(
-        notification_public_key=client.notification_public_key,
+        notification_public_key=client["notification_public_key"],
+        payload_format=notifier.mqtt_notifier.payload_format(client["uuid"]),
     )
 
 @app.get("/status")
 async def get_status():
-    online_count = sum(
-        1 for status in notifier.mqtt_notifier.device_statuses.values() if status
-    )
     uptime_seconds = int(time.time() - start_time)
     return {
         "message": "OK",
         "mqtt_connected": notifier.mqtt_notifier.is_connected(),
+        "status_leader": notifier.mqtt_notifier.is_leader,
         "uptime_seconds": uptime_seconds,
-        "online_devices": online_count,
+        "online_devices": notifier.mqtt_notifier.presence.online_count(),
+        "presence_stale": notifier.mqtt_notifier.presence_stale_since is not None,
+        "status_verifications_skipped": notifier.mqtt_notifier.verifications_skipped,
+        "status_reloads_skipped": notifier.mqtt_notifier.reloads_skipped,
+        "key_cache": notifier.mqtt_notifier.key_cache.stats(),
+        "coalesced_notifications": notifier.coalescer.coalesced,
+        "status_pipeline": notifier.mqtt_notifier.status_pipeline.stats(),
     }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Pipeline metrics of this worker process in the Prometheus text format."""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
@@ -1,7 +1,7 @@
 from pydantic import BaseModel, EmailStr
 from enum import Enum
 from uuid import UUID
-from typing import Optional
+from typing import List, Optional
 
 class NotificationMethod(str, Enum):
     mqtt = "mqtt"
@@ -14,10 +14,19 @@ class NotificationRequest(BaseModel):
     queue_if_offline: bool = False
     collapse_duplicates: bool = True
 
+class BatchNotificationRequest(BaseModel):
+    recipient_emails: List[EmailStr]
+    message_title: str
+    message_body: str
+    method: NotificationMethod = NotificationMethod.mqtt
+    queue_if_offline: bool = False
+    collapse_duplicates: bool = True
+
 class EncryptedNotificationRequest(BaseModel):
     recipient_email: EmailStr
-    encrypted_title: str
-    encrypted_body: str
+    encrypted_title: Optional[str] = None
+    encrypted_body: Optional[str] = None
+    encrypted_payload: Optional[str] = None  # payload format 2, instead of title and body
     method: NotificationMethod = NotificationMethod.mqtt
     queue_if_offline: bool = False
     collapse_duplicates: bool = True
@@ -33,3 +42,4 @@ class PublicKeyRequest(BaseModel):
 
 class PublicKeyResponse(BaseModel):
     notification_public_key: str
+    payload_format: int
@@ -0,0 +1,205 @@
+from datetime import datetime
+from sqlalchemy import bindparam, or_, select, update
+from schemas import Client
+import asyncio
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Hot statements are built once, so SQLAlchemy's compiled cache and SQLite's
+# per-connection statement cache keep reusing the same prepared statement.
+# Core (not ORM) statements, so a list of parameters runs as one executemany.
+UPDATE_LAST_SEEN_ONLINE = (
+    update(Client.__table__)
+    .where(Client.__table__.c.uuid == bindparam("device_uuid"))
+    .values(last_seen_online=bindparam("seen_at"))
+)
+SELECT_CLIENTS = select(
+    Client.uuid,
+    Client.email,
+    Client.notification_public_key,
+    Client.status_public_key,
+    Client.last_seen_online,
+)
+
+
+class ClientDirectory:
+    """
+    In-memory copy of the `clients` table (email -> uuid, uuid -> keys and last seen),
+    loaded once at startup and kept up to date by /register and status handling,
+    so notification delivery never has to query the database.
+
+    last_seen_online writes are buffered and flushed in a single transaction every
+    `flush_interval` seconds, or sooner once `flush_size` devices are waiting.
+    """
+
+    def __init__(self, session_factory, flush_interval=5.0, flush_size=500):
+        self.session_factory = session_factory
+        self._clients = {}  # uuid -> client dict
+        self._uuid_by_email = {}  # email -> uuid
+        self._lock = threading.Lock()
+
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._unflushed_last_seen = {}  # uuid -> last_seen_online not yet written
+        self._last_seen_lock = threading.Lock()
+        self._flush_requested = None
+        self._writer_task = None
+        self.loop = None
+
+    async def load(self):
+        async with self.session_factory() as session:
+            result = await session.execute(SELECT_CLIENTS)
+            rows = result.all()
+
+        with self._lock:
+            self._clients = {}
+            self._uuid_by_email = {}
+            for uuid, email, notification_public_key, status_public_key, last_seen_online in rows:
+                self._put(uuid, email, notification_public_key, status_public_key, self._parse_datetime(last_seen_online))
+
+        logger.info("Loaded %d clients into the client directory", len(rows))
+
+    async def reload(self, uuids=(), emails=()):
+        """
+        Re-read specific clients from the database. With several API workers, a client may
+        have registered through another worker after this one loaded the directory.
+        """
+        conditions = []
+        if uuids:
+            conditions.append(Client.uuid.in_(list(uuids)))
+        if emails:
+            conditions.append(Client.email.in_(list(emails)))
+        if not conditions:
+            return
+
+        async with self.session_factory() as session:
+            result = await session.execute(SELECT_CLIENTS.where(or_(*conditions)))
+            rows = result.all()
+
+        with self._lock:
+            for uuid, email, notification_public_key, status_public_key, last_seen_online in rows:
+                previous = self._clients.get(uuid)
+                if previous and previous["last_seen_online"] is not None:
+                    # Ours may not have been flushed yet, and is never older than the row.
+                    last_seen_online = previous["last_seen_online"]
+                self._put(uuid, email, notification_public_key, status_public_key, self._parse_datetime(last_seen_online))
+
+    @staticmethod
+    def _parse_datetime(value):
+        if not value:
+            return None
+        if isinstance(value, datetime):
+            return value
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            return None
+
+    def _put(self, uuid, email, notification_public_key, status_public_key, last_seen_online):
+        previous = self._clients.get(uuid)
+        if previous and previous["email"] != email:
+            self._uuid_by_email.pop(previous["email"], None)
+
+        self._clients[uuid] = {
+            "uuid": uuid,
+            "email": email,
+            "notification_public_key": notification_public_key,
+            "status_public_key": status_public_key,
+            "last_seen_online": last_seen_online,
+        }
+        self._uuid_by_email[email] = uuid
+
+    def put(self, uuid, email, notification_public_key, status_public_key, last_seen_online=None):
+        with self._lock:
+            self._put(uuid, email, notification_public_key, status_public_key, last_seen_online)
+
+    def get(self, uuid):
+        return self._clients.get(uuid)
+
+    def get_by_email(self, email):
+        uuid = self._uuid_by_email.get(email)
+        if uuid is None:
+            return None
+        return self._clients.get(uuid)
+
+    def get_many_by_email(self, emails):
+        """Resolve many recipients at once; unknown emails are omitted from the result."""
+        clients = {}
+        for email in emails:
+            client = self.get_by_email(email)
+            if client:
+                clients[email] = client
+        return clients
+
+    def get_last_seen_online(self, uuid):
+        client = self._clients.get(uuid)
+        return client["last_seen_online"] if client else None
+
+    def set_last_seen_online(self, uuid, last_seen_online):
+        client = self._clients.get(uuid)
+        if client:
+            client["last_seen_online"] = last_seen_online
+
+    def update_last_seen_online(self, uuid, last_seen_online):
+        """Record a last-seen time now and write it behind. Safe to call from any thread."""
+        self.set_last_seen_online(uuid, last_seen_online)
+        with self._last_seen_lock:
+            self._unflushed_last_seen[uuid] = last_seen_online
+            backlog = len(self._unflushed_last_seen)
+
+        if backlog >= self.flush_size and self.loop is not None:
+            self.loop.call_soon_threadsafe(self._flush_requested.set)
+
+    def start_last_seen_writer(self):
+        self.loop = asyncio.get_running_loop()
+        self._flush_requested = asyncio.Event()
+        self._writer_task = asyncio.ensure_future(self._run_last_seen_writer())
+
+    async def stop_last_seen_writer(self):
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            try:
+                await self._writer_task
+            except asyncio.CancelledError:
+                pass
+            self._writer_task = None
+        await self.flush_last_seen()
+
+    async def _run_last_seen_writer(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+
+            try:
+                await self.flush_last_seen()
+            except Exception as e:
+                logger.error("Failed to flush last_seen_online updates: %s", e)
+
+    async def flush_last_seen(self):
+        with self._last_seen_lock:
+            batch = self._unflushed_last_seen
+            self._unflushed_last_seen = {}
+        if not batch:
+            return
+
+        try:
+            async with self.session_factory() as session:
+                await session.execute(
+                    UPDATE_LAST_SEEN_ONLINE,
+                    [{"device_uuid": uuid, "seen_at": seen_at} for uuid, seen_at in batch.items()],
+                )
+                await session.commit()
+        except Exception:
+            # Put the batch back without overwriting anything newer that arrived meanwhile.
+            with self._last_seen_lock:
+                for uuid, seen_at in batch.items():
+                    self._unflushed_last_seen.setdefault(uuid, seen_at)
+            raise
+
+    def __len__(self):
+        return len(self._clients)
@@ -0,0 +1,77 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Coalescer:
+    """
+    Server-side coalescing window for `collapse_duplicates` notifications.
+
+    The first notification for a (recipient, title) key is sent right away and opens a window.
+    Notifications for the same key that arrive while the window is open are held, each one
+    replacing the previous, and only the latest is sent when the window closes. Superseded
+    messages are never encrypted or published.
+
+    All methods must be called from the event loop thread.
+    """
+
+    def __init__(self, window_seconds=0.0):
+        self.window_seconds = window_seconds
+        self.coalesced = 0  # notifications dropped because a newer one replaced them
+        self._windows = {}  # key -> held send coroutine function, or None if nothing is held
+        self._timers = {}  # key -> handle that closes its window
+        self._sending = set()  # tasks sending notifications whose window closed
+
+    @property
+    def enabled(self):
+        return self.window_seconds > 0
+
+    def submit(self, key, send) -> bool:
+        """
+        Returns True if the caller should send now. Otherwise `send` (a coroutine function)
+        is held and will be awaited when the window for `key` closes.
+        """
+        if key in self._windows:
+            if self._windows[key] is not None:
+                self.coalesced += 1
+            self._windows[key] = send
+            return False
+
+        self._open_window(key)
+        return True
+
+    def _open_window(self, key):
+        self._windows[key] = None
+        self._timers[key] = asyncio.get_running_loop().call_later(self.window_seconds, self._close_window, key)
+
+    def _close_window(self, key):
+        self._timers.pop(key, None)
+        send = self._windows.pop(key, None)
+        if send is not None:
+            # Send the latest held notification, and keep coalescing behind it.
+            self._open_window(key)
+            task = asyncio.ensure_future(self._run(send))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def flush(self):
+        """
+        Close every window now and send what is held, waiting for those sends and any already
+        under way. Held notifications were accepted by the API, so call this before shutdown.
+        """
+        for timer in self._timers.values():
+            timer.cancel()
+        held = [send for send in self._windows.values() if send is not None]
+        self._windows.clear()
+        self._timers.clear()
+        await asyncio.gather(*self._sending, *(self._run(send) for send in held))
+
+    async def _run(self, send):
+        try:
+            await send()
+        except Exception as e:
+            logger.error("Coalesced notification send failed: %s", e)
+
+    def pending_count(self):
+        return sum(1 for send in self._windows.values() if send is not None)
@@ -0,0 +1,65 @@
+from concurrent.futures import ProcessPoolExecutor
+from notifications.key_cache import KeyCache
+from notifications.payload import PayloadBuilder
+from notifications.session_keys import SessionKeyCache
+import asyncio
+import multiprocessing
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Per-process state of pool workers, set up by _init_worker.
+_worker_payload_builder = None
+
+
+def _init_worker(key_cache_size, session_key_max_age, session_key_max_messages):
+    global _worker_payload_builder
+    _worker_payload_builder = PayloadBuilder(
+        KeyCache(max_size=key_cache_size),
+        SessionKeyCache(max_size=key_cache_size, max_age=session_key_max_age, max_messages=session_key_max_messages),
+    )
+
+
+def _create_payload(recipient_uuid, public_key_pem, message_title, message_body, collapse_duplicates, payload_format):
+    return _worker_payload_builder.create_payload(
+        recipient_uuid, public_key_pem, message_title, message_body, collapse_duplicates, payload_format
+    )
+
+
+class EncryptionPool:
+    """
+    Runs notification encryption off the event loop.
+    With workers > 0, jobs go to a pool of worker processes (each with its own key cache)
+    so RSA throughput scales with CPU cores instead of contending for the GIL.
+    Each worker also keeps its own format 3 session keys, so a device may hold one per worker.
+    With workers = 0, jobs run on a thread in this process using the caller's PayloadBuilder.
+    """
+
+    def __init__(self, workers=0, key_cache_size=10000, session_key_max_age=86400.0, session_key_max_messages=1000):
+        self.workers = workers
+        self.executor = None
+
+        if workers > 0:
+            # Spawn rather than fork: the MQTT network thread may already be running.
+            self.executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(key_cache_size, session_key_max_age, session_key_max_messages),
+            )
+            # Start the workers now instead of on the first notification.
+            self.executor.submit(int).result()
+            logger.info("Started encryption pool with %d worker processes", workers)
+
+    async def create_payload(self, local_builder, recipient_uuid, public_key_pem, message_title, message_body, collapse_duplicates, payload_format):
+        args = (recipient_uuid, public_key_pem, message_title, message_body, collapse_duplicates, payload_format)
+        if self.executor is None:
+            return await asyncio.to_thread(local_builder.create_payload, *args)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, _create_payload, *args)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
@@ -0,0 +1,64 @@
+from collections import OrderedDict
+from Crypto.PublicKey import RSA
+from Crypto.Cipher import PKCS1_v1_5
+from Crypto.Signature import pkcs1_15
+import threading
+
+
+class KeyCache:
+    """
+    Bounded LRU cache of parsed RSA public keys, keyed by device uuid.
+    Holds ready-to-use PKCS#1 v1.5 ciphers (notification keys) and pkcs1_15
+    verifiers (status keys) so a PEM is only parsed once per device.
+    """
+
+    NOTIFICATION = "notification"
+    STATUS = "status"
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # (device_uuid, purpose) -> (public_key_pem, cipher/verifier)
+        self._lock = threading.Lock()
+
+    def get_cipher(self, device_uuid: str, public_key_pem: str):
+        return self._get(device_uuid, self.NOTIFICATION, public_key_pem, PKCS1_v1_5.new)
+
+    def get_verifier(self, device_uuid: str, public_key_pem: str):
+        return self._get(device_uuid, self.STATUS, public_key_pem, pkcs1_15.new)
+
+    def _get(self, device_uuid, purpose, public_key_pem, factory):
+        cache_key = (device_uuid, purpose)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            # A changed PEM means the row was replaced behind our back; treat it as a miss.
+            if entry is not None and entry[0] == public_key_pem:
+                self._entries.move_to_end(cache_key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        # Parse outside the lock; a concurrent miss for the same device just parses twice.
+        value = factory(RSA.import_key(public_key_pem))
+
+        with self._lock:
+            self._entries[cache_key] = (public_key_pem, value)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, device_uuid: str):
+        with self._lock:
+            self._entries.pop((device_uuid, self.NOTIFICATION), None)
+            self._entries.pop((device_uuid, self.STATUS), None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,51 @@
+import fcntl
+import os
+import stat
+
+
+class LeaderLock:
+    """
+    Picks one process on the node to subscribe to device statuses.
+
+    The leader holds an exclusive flock on `path` for as long as it runs. The kernel
+    releases the lock when the process exits, however it exits, so a waiting worker
+    can take over on its next attempt.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    @property
+    def held(self) -> bool:
+        return self._fd is not None
+
+    def try_acquire(self) -> bool:
+        if self._fd is not None:
+            return True
+
+        # Never follow a symlink, or use a file another user created: the lock file gets truncated.
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        try:
+            info = os.fstat(fd)
+            if not stat.S_ISREG(info.st_mode) or info.st_uid != os.getuid():
+                raise PermissionError(f"{self.path} is not a regular file owned by this user")
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        except BaseException:
+            os.close(fd)
+            raise
+
+        # Record who leads, for whoever is looking at the node.
+        os.ftruncate(fd, 0)
+        os.write(fd, f"{os.getpid()}\n".encode())
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,20 @@
+from util.metrics import REGISTRY
+
+# Where /notify time goes. Each API worker process keeps its own values.
+NOTIFY_SECONDS = REGISTRY.histogram(
+    "pingberry_notify_seconds", "Time to handle a notification request", labels=("endpoint",)
+)
+NOTIFICATION_RESULTS = REGISTRY.counter(
+    "pingberry_notification_results_total", "Notification outcomes by result code", labels=("endpoint", "code")
+)
+LOOKUP_SECONDS = REGISTRY.histogram("pingberry_lookup_seconds", "Time to resolve recipients to clients")
+ENCRYPTION_SECONDS = REGISTRY.histogram("pingberry_encryption_seconds", "Time to build an encrypted payload")
+PUBLISH_SECONDS = REGISTRY.histogram("pingberry_publish_seconds", "Time to hand a message to the MQTT client")
+PUBACK_WAIT_SECONDS = REGISTRY.histogram("pingberry_puback_wait_seconds", "Time from publish to the broker's PUBACK")
+PUBLISHES_IN_FLIGHT = REGISTRY.gauge("pingberry_publishes_in_flight", "Publishes waiting for a PUBACK")
+
+STATUS_MESSAGES = REGISTRY.counter(
+    "pingberry_status_messages_total",
+    "Status messages handled, by outcome (verified, skipped, invalid, unknown_device, dropped, error)",
+    labels=("result",),
+)
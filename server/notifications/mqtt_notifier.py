@@ -1,262 +1,503 @@
 import paho.mqtt.client as mqtt
+import asyncio
 import ssl
 import time
 import json
-import random
-import string
 import uuid
-import threading
-from Crypto.PublicKey import RSA
-from Crypto.Cipher import PKCS1_v1_5
-from Crypto.Signature import pkcs1_15
+import zlib
+import hashlib
 from Crypto.Hash import SHA256
+from notifications.key_cache import KeyCache
+from notifications.payload import (
+    PayloadBuilder, PAYLOAD_FORMAT_RSA, PAYLOAD_FORMAT_HYBRID, PAYLOAD_FORMAT_SESSION, SUPPORTED_PAYLOAD_FORMATS
+)
+from notifications.session_keys import SessionKeyCache
+from notifications.status_pipeline import StatusPipeline
+from notifications.presence import LocalPresenceStore
+from notifications.metrics import ENCRYPTION_SECONDS, PUBACK_WAIT_SECONDS, PUBLISH_SECONDS, PUBLISHES_IN_FLIGHT, STATUS_MESSAGES
+import threading
+from collections import OrderedDict
 from datetime import datetime, timedelta
 import base64
-import sqlite3
-import threading
+import logging
+
+logger = logging.getLogger(__name__)
 
 class MQTTNotification:
-    def __init__(self, db_path, broker, port, ca_cert, username, password):
-        self.db_path = db_path
+    def __init__(self, client_directory, outbox, broker, port, ca_cert, username, password, encryption_pool, publish_timeout=None, key_cache_size=10000, status_workers=4, reload_backoff=300.0, max_reloads_per_second=20.0, publisher_connections=1, presence=None, leader_lock=None, leader_retry_interval=5.0, outbox_sweep_interval=30.0, presence_grace_period=30.0, session_keys=False, session_key_max_age=86400.0, session_key_max_messages=1000):
+        self.client_directory = client_directory
+        self.outbox = outbox
+        self.draining_devices = set()  # devices whose outbox is being replayed (event loop only)
+        self.broker = broker
+        self.port = port
         self.status_topic_filter = "status/+"
-        self.device_statuses = {}  # device_uuid -> True/False
-        self.connected = False
+        self.presence = presence or LocalPresenceStore()
+
+        # Presence is kept through a lost status subscription and marked stale. Once resubscribed,
+        # the broker resends every retained status; devices that haven't reported again within
+        # `presence_grace_period` seconds are then marked offline.
+        self.presence_grace_period = presence_grace_period
+        self.presence_stale_since = None
+        self._presence_reconcile = None
+        self._reconcile_cutoff = None
+
+        # The presence store keeps a digest of each device's last verified status. Retained statuses
+        # are resent unchanged on every resubscription, so most need no RSA work.
+        self.verifications_skipped = 0
+
+        # A status that fails to verify re-reads its device from the database, blocking a status
+        # worker. Anyone can publish to status/+, so each (device, key it failed with) is only
+        # reloaded once per `reload_backoff` seconds, and reloads overall are rate limited.
+        self.reload_backoff = reload_backoff
+        self.max_reloads_per_second = max_reloads_per_second
+        self._reload_attempts = OrderedDict()  # device_uuid -> (key digest, monotonic time)
+        self._reload_attempts_max = key_cache_size
+        self._reload_tokens = max_reloads_per_second
+        self._reload_tokens_at = time.monotonic()
+        self._reload_lock = threading.Lock()
+        self.reloads_skipped = 0
+        self.connected_shards = set()
         self.subscribed = False
-
-        self.client = mqtt.Client(
+        self._subscribe_lock = threading.Lock()
+
+        # With several API workers on a node, only the holder of the leader lock subscribes to
+        # statuses and maintains presence; the others only publish. No lock means always leader.
+        self.leader_lock = leader_lock
+        self.leader_retry_interval = leader_retry_interval
+        self.is_leader = leader_lock is None
+        self._leader_task = None
+
+        # Only the leader replays outboxes, so two workers never publish the same entries. Entries
+        # other workers queue for a device that is already online are found by a periodic sweep.
+        self.outbox_sweep_interval = outbox_sweep_interval
+        self._sweep_task = None
+
+        # Event loop that owns all async work; paho's network threads hand results over to it.
+        # Async publishes awaiting their PUBACK: (shard, mid) -> asyncio.Future (resolved on self.loop)
+        self.loop = None
+        self.pending_publishes = {}
+        self.publish_timeout = publish_timeout
+
+        self.key_cache = KeyCache(max_size=key_cache_size)
+        self.payload_builder = PayloadBuilder(
+            self.key_cache,
+            SessionKeyCache(max_size=key_cache_size, max_age=session_key_max_age, max_messages=session_key_max_messages),
+        )
+        # Devices advertise every format they can read; session keys (format 3) are only used when enabled here.
+        self.max_payload_format = PAYLOAD_FORMAT_SESSION if session_keys else PAYLOAD_FORMAT_HYBRID
+        self.encryption_pool = encryption_pool
+        self.status_pipeline = StatusPipeline(self.handle_status_message, workers=status_workers)
+
+        # Publishes are spread over several broker connections, each with its own socket and
+        # network thread. Shard 0 also subscribes to device statuses.
+        self.clients = [
+            self._create_client(shard, ca_cert, username, password)
+            for shard in range(max(1, publisher_connections))
+        ]
+        self.client = self.clients[0]
+
+    def _create_client(self, shard, ca_cert, username, password):
+        client = mqtt.Client(
             callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
             protocol=mqtt.MQTTv5,
             client_id=str(uuid.uuid4())
         )
+        client.user_data_set({"shard": shard})
+
+        client.tls_set(ca_certs=ca_cert, tls_version=ssl.PROTOCOL_TLS)
+        client.username_pw_set(username, password)
+
+        client.on_connect = self.on_connect
+        client.on_disconnect = self.on_disconnect
+        client.on_message = self.on_status_message
+        client.on_publish = self.on_publish
+
+        client.reconnect_delay_set(min_delay=1, max_delay=60)
+        return client
+
+    def start(self):
+        """Connect to the broker. Must be called from the event loop that serves requests."""
+        self.loop = asyncio.get_running_loop()
+        self.status_pipeline.start()
+        if not self.is_leader:
+            self._leader_task = asyncio.ensure_future(self._wait_for_leadership())
+        for client in self.clients:
+            client.connect_async(self.broker, self.port, 30)
+            client.loop_start()
+
+    async def _wait_for_leadership(self):
+        while not self.leader_lock.try_acquire():
+            await asyncio.sleep(self.leader_retry_interval)
+
+        logger.info("Became status leader for this node")
+        # Whatever the previous leader left behind is reconciled against retained statuses.
+        self._mark_presence_stale()
+        self.is_leader = True
+        if 0 in self.connected_shards:
+            self.subscribe_statuses(self.client)
+        if self.outbox.shared:
+            self._sweep_task = asyncio.ensure_future(self._sweep_outboxes())
+
+    async def _sweep_outboxes(self):
+        while True:
+            await asyncio.sleep(self.outbox_sweep_interval)
+            try:
+                for device_uuid in await self.outbox.queued_devices():
+                    if self.is_device_online(device_uuid):
+                        self._start_outbox_drain(device_uuid)
+            except Exception as e:
+                logger.error("Outbox sweep failed: %s", e)
+
+    def shard_for(self, device_uuid: str) -> int:
+        # Stable across restarts, so a device's notifications always share one connection and stay in order.
+        return zlib.crc32(device_uuid.encode()) % len(self.clients)
+
+    def run_on_loop(self, coro):
+        """Schedule a coroutine on the event loop from paho's network thread."""
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(self._log_background_error)
+
+    @staticmethod
+    def _log_background_error(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("Background task failed: %s", future.exception())
+
+    def reload_client(self, device_uuid: str):
+        """Re-read a client from the database. Blocks, so only call it from a status worker."""
+        future = asyncio.run_coroutine_threadsafe(self.client_directory.reload(uuids=[device_uuid]), self.loop)
+        future.result(timeout=10)
+
+    def may_reload_client(self, device_uuid: str, stale_public_key_pem) -> bool:
+        """Whether a status that failed with `stale_public_key_pem` (None: unknown device) may reload its device."""
+        try:
+            uuid.UUID(device_uuid)
+        except ValueError:
+            return False
 
-        self.client.tls_set(ca_certs=ca_cert, tls_version=ssl.PROTOCOL_TLS)
-        self.client.username_pw_set(username, password)
+        key_digest = hashlib.blake2b((stale_public_key_pem or "").encode(), digest_size=8).digest()
+        now = time.monotonic()
+        with self._reload_lock:
+            attempt = self._reload_attempts.get(device_uuid)
+            if attempt is not None and attempt[0] == key_digest and now - attempt[1] < self.reload_backoff:
+                self.reloads_skipped += 1
+                return False
 
-        self.client.on_connect = self.on_connect
-        self.client.on_disconnect = self.on_disconnect
-        self.client.on_message = self.on_status_message
+            self._reload_tokens = min(
+                self.max_reloads_per_second,
+                self._reload_tokens + (now - self._reload_tokens_at) * self.max_reloads_per_second,
+            )
+            self._reload_tokens_at = now
+            if self._reload_tokens < 1:
+                self.reloads_skipped += 1
+                return False
+            self._reload_tokens -= 1
 
-        self.client.reconnect_delay_set(min_delay=1, max_delay=60)
-        self.client.connect(broker, port, 30)
-        self.client.loop_start()
+            self._reload_attempts[device_uuid] = (key_digest, now)
+            self._reload_attempts.move_to_end(device_uuid)
+            if len(self._reload_attempts) > self._reload_attempts_max:
+                self._reload_attempts.popitem(last=False)
+        return True
 
-    def verify_signed_status(self, payload_dict: dict, public_key_pem: str) -> bool:
+    def verify_signed_status(self, payload_dict: dict, device_uuid: str, public_key_pem: str):
+        """Digest of the status if its signature verifies (to record with the device's state), else None."""
         try:
             signature_b64 = payload_dict.get("signature")
             signed_payload = payload_dict.get("payload")
             if not signature_b64 or not signed_payload:
-                return False
+                return None
+
+            # The key is part of the digest, so a re-registration with new keys verifies again.
+            digest = hashlib.blake2b(
+                "\0".join((public_key_pem, signature_b64, signed_payload)).encode(), digest_size=16
+            ).digest()
+            if self.presence.status_digest(device_uuid) == digest:
+                self.verifications_skipped += 1
+                STATUS_MESSAGES.inc(result="skipped")
+                return digest
 
             signature = base64.b64decode(signature_b64)
-            public_key = RSA.import_key(public_key_pem)
+            verifier = self.key_cache.get_verifier(device_uuid, public_key_pem)
             h = SHA256.new(signed_payload.encode())
 
-            pkcs1_15.new(public_key).verify(h, signature)
-            return True
+            verifier.verify(h, signature)
+            STATUS_MESSAGES.inc(result="verified")
+            return digest
         except (ValueError, TypeError):
-            return False
-
-    def encrypt_message(self, public_key_pem: str, message: str) -> str:
-        pubkey = RSA.import_key(public_key_pem)
-        cipher = PKCS1_v1_5.new(pubkey)
-        ciphertext = cipher.encrypt(message.encode())
-        return base64.b64encode(ciphertext).decode()
+            return None
 
     def on_connect(self, client, userdata, flags, reasonCode, properties):
-        self.connected = True
-        print("MQTT connected with reason code:", reasonCode)
+        shard = userdata["shard"]
+        self.connected_shards.add(shard)
+        logger.info("MQTT connection %d connected: %s", shard, reasonCode)
+
+        if shard == 0 and self.is_leader:
+            self.subscribe_statuses(client)
+
+    def subscribe_statuses(self, client):
+        with self._subscribe_lock:
+            if not self.subscribed:
+                client.subscribe(self.status_topic_filter)
+                self.subscribed = True
+                logger.info("Subscribed to topic: %s", self.status_topic_filter)
+                self.call_on_loop(self._schedule_presence_reconcile)
+            else:
+                logger.debug("Already subscribed; skipping duplicate subscription")
+
+    def call_on_loop(self, callback, *args):
+        """Run a callback on the event loop from any thread."""
+        loop = self.loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(callback, *args)
+
+    def _mark_presence_stale(self):
+        if self._presence_reconcile is not None:
+            self._presence_reconcile.cancel()
+            self._presence_reconcile = None
+        if self.presence_stale_since is None:
+            self.presence_stale_since = int(time.time())
+
+    def _schedule_presence_reconcile(self):
+        if self.presence_stale_since is None:
+            return
+        if self._presence_reconcile is not None:
+            self._presence_reconcile.cancel()
+        # Every status re-received from here on is at least this recent.
+        self._reconcile_cutoff = int(time.time())
+        self._presence_reconcile = self.loop.call_later(self.presence_grace_period, self._reconcile_presence)
+
+    def _reconcile_presence(self):
+        self._presence_reconcile = None
+        expired = self.presence.expire_before(self._reconcile_cutoff)
+        self.presence_stale_since = None
+        logger.info("Presence reconciled; %d devices did not report again and are now offline", expired)
 
-        if not self.subscribed:
-            client.subscribe(self.status_topic_filter)
-            self.subscribed = True
-            print(f"Subscribed to topic: {self.status_topic_filter}")
-        else:
-            print("Already subscribed; skipping duplicate subscription.")
+    def on_disconnect(self, client, userdata, flags, reasonCode, properties):
+        shard = userdata["shard"]
+        self.connected_shards.discard(shard)
+        logger.warning("MQTT connection %d disconnected: %s", shard, reasonCode)
 
+        if shard == 0:
+            with self._subscribe_lock:
+                self.subscribed = False
+            if self.is_leader:
+                self.call_on_loop(self._mark_presence_stale)
 
-    def on_disconnect(self, client, userdata, flags, reasonCode, properties):
-        self.connected = False
-        self.subscribed = False
-        print(f"MQTT disconnected with reason code: {reasonCode}")
-        self.device_statuses = {}
+    def on_publish(self, client, userdata, mid, reasonCode, properties):
+        # Runs on paho's network thread; hand the result over to the event loop.
+        self.call_on_loop(self._resolve_publish, (userdata["shard"], mid), not reasonCode.is_failure)
+
+    def _resolve_publish(self, key, success):
+        future = self.pending_publishes.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(success)
 
     def is_connected(self):
-        return self.connected
+        return len(self.connected_shards) == len(self.clients)
 
     def get_status_public_key(self, device_uuid: str):
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT status_public_key FROM clients WHERE uuid=?", (device_uuid,))
-            row = cursor.fetchone()
-            if row:
-                return row[0]
-        return None
+        client = self.client_directory.get(device_uuid)
+        return client["status_public_key"] if client else None
 
     def get_notification_public_key(self, device_uuid: str):
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT notification_public_key FROM clients WHERE uuid=?",
-                (device_uuid,),
-            )
-            row = cursor.fetchone()
-            if row:
-                return row[0]
-        return None
+        client = self.client_directory.get(device_uuid)
+        return client["notification_public_key"] if client else None
 
     def on_status_message(self, client, userdata, msg):
-        try:
-            data = json.loads(msg.payload.decode())
-            topic_parts = msg.topic.strip('/').split('/')
-            if len(topic_parts) == 2 and topic_parts[0] == 'status':
-                device_uuid = topic_parts[1]
+        # Runs on paho's network thread: only route the message, a status worker handles it.
+        topic_parts = msg.topic.strip('/').split('/')
+        if len(topic_parts) != 2 or topic_parts[0] != 'status':
+            return
 
-                # Fetch status-public key from DB
-                public_key_pem = self.get_status_public_key(device_uuid)
+        device_uuid = topic_parts[1]
+        try:
+            uuid.UUID(device_uuid)
+        except ValueError:
+            STATUS_MESSAGES.inc(result="invalid")
+            return
+        known = self.client_directory.get(device_uuid) is not None
+        if not self.status_pipeline.submit(device_uuid, msg.payload, known=known):
+            STATUS_MESSAGES.inc(result="dropped")
+
+    def handle_status_message(self, device_uuid, raw_payload):
+        try:
+            data = json.loads(raw_payload.decode())
+
+            # Fetch status-public key from the client directory
+            public_key_pem = self.get_status_public_key(device_uuid)
+            status_digest = self.verify_signed_status(data, device_uuid, public_key_pem) if public_key_pem else None
+            if status_digest is None:
+                # The device may have registered, or re-registered with new keys, through another API worker.
+                stale_public_key_pem = public_key_pem
+                if self.may_reload_client(device_uuid, stale_public_key_pem):
+                    self.reload_client(device_uuid)
+                    public_key_pem = self.get_status_public_key(device_uuid)
                 if not public_key_pem:
-                    print(f"No public key found for {device_uuid}")
+                    STATUS_MESSAGES.inc(result="unknown_device")
+                    logger.warning("No public key found for status", extra={"device": device_uuid, "sampled": True})
                     return
 
-                if not self.verify_signed_status(data, public_key_pem):
-                    print(f"Invalid signature on status from {device_uuid}")
+                if public_key_pem != stale_public_key_pem:
+                    status_digest = self.verify_signed_status(data, device_uuid, public_key_pem)
+                if status_digest is None:
+                    STATUS_MESSAGES.inc(result="invalid")
+                    logger.warning("Invalid signature on status", extra={"device": device_uuid, "sampled": True})
                     return
 
-                payload = json.loads(data["payload"])
-                status = bool(payload.get('status', False))
-                self.device_statuses[device_uuid] = status
-
-                print(f"Device '{device_uuid}' is now {'online' if status else 'offline'}")
-
-                # Only send welcome when device goes online
-                if status:
-                    last_seen = self.get_last_seen_online(device_uuid)
-                    now = datetime.utcnow()
-
-                    # Send welcome if first time seeing the device online
-                    if last_seen is None:
-                        notif_key = self.get_notification_public_key(device_uuid)
-                        if notif_key:
-                            print(f"Sending welcome message to {device_uuid}")
-                            threading.Thread(
-                                target=self.send,
-                                args=(
-                                    "Welcome to PingBerry!",
-                                    "You're connected and will receive notifications here.\nTo start, link your favorite services or send notifications using the PingBerry API\nhttps://github-md.com/andreytakhtamirov/pingberry/blob/main/docs/api-docs.md#post-notify",
-                                    device_uuid,
-                                    notif_key,
-                                    False,
-                                ),
-                                daemon=True,
-                            ).start()
-                        else:
-                            print(f"No notification key found for {device_uuid}")
-
-                    # Always update last_seen_online
-                    self.update_last_seen_online(device_uuid)
-
-        except Exception as e:
-            print(f"Failed to parse status message: {e}")
-
-    def generate_message_id(self):
-        return ''.join(random.choices(string.ascii_letters + string.digits, k=10))
+            payload = json.loads(data["payload"])
+            status = bool(payload.get('status', False))
+            payload_format = max(
+                (f for f in payload.get("formats", ()) if f in SUPPORTED_PAYLOAD_FORMATS), default=PAYLOAD_FORMAT_RSA
+            )
+            was_online = self.presence.set_online(device_uuid, status, payload_format, status_digest)
 
-    def create_payload(self, public_key_pem, message_title, message_body, collapse_duplicates):
-        message_title_encrypted = self.encrypt_message(public_key_pem, message_title)
+            logger.info(
+                "Device is now %s", "online" if status else "offline", extra={"device": device_uuid, "sampled": True}
+            )
 
-        if collapse_duplicates:
-            # Replace any existing notification with the same title.
-            item_id_encrypted = message_title_encrypted
-        else:
-            # Create unique notification.
-            item_id_encrypted = self.encrypt_message(public_key_pem, self.generate_message_id())
-        
-        payload_dict = {
-            "itemid": item_id_encrypted,
-            "title": message_title_encrypted,
-            "subtitle": self.encrypt_message(public_key_pem, message_body),
-            # "target": "defaultTarget",
-            # "targetAction": "defaultTargetAction",
-            # "payload": "defaultPayload",
-            # "payloadType": "defaultPayloadType",
-            # "payloadURI": "defaultPayloadURI"
-        }
-        return json.dumps(payload_dict)
-
-    def create_encrypted_payload(self, public_key_pem, encrypted_title, encrypted_body, collapse_duplicates):
-        if collapse_duplicates:
-            # Replace any existing notification with the same title.
-            item_id_encrypted = encrypted_title
-        else:
-            # Create unique notification.
-            item_id_encrypted = self.encrypt_message(public_key_pem, self.generate_message_id())
-        
-        payload_dict = {
-            "itemid": item_id_encrypted,
-            "title": encrypted_title,
-            "subtitle": encrypted_body,
-            # "target": "defaultTarget",
-            # "targetAction": "defaultTargetAction",
-            # "payload": "defaultPayload",
-            # "payloadType": "defaultPayloadType",
-            # "payloadURI": "defaultPayloadURI"
-        }
-        return json.dumps(payload_dict)
+            # Only send welcome when device goes online
+            if status:
+                last_seen = self.get_last_seen_online(device_uuid)
+                now = datetime.utcnow()
+
+                # Send welcome if first time seeing the device online
+                if last_seen is None:
+                    notif_key = self.get_notification_public_key(device_uuid)
+                    if notif_key:
+                        logger.info("Sending welcome message", extra={"device": device_uuid})
+                        self.run_on_loop(
+                            self.send_async(
+                                "Welcome to PingBerry!",
+                                "You're connected and will receive notifications here.\nTo start, link your favorite services or send notifications using the PingBerry API\nhttps://github-md.com/andreytakhtamirov/pingberry/blob/main/docs/api-docs.md#post-notify",
+                                device_uuid,
+                                notif_key,
+                                False,
+                                min(payload_format, self.max_payload_format),
+                            )
+                        )
+                    else:
+                        logger.warning("No notification key found", extra={"device": device_uuid})
+
+                # Always update last_seen_online
+                self.client_directory.update_last_seen_online(device_uuid, now)
+
+                # Replay notifications queued while the device was offline
+                if not was_online:
+                    self.start_outbox_drain(device_uuid)
 
+        except Exception as e:
+            STATUS_MESSAGES.inc(result="error")
+            logger.warning("Failed to parse status message: %s", e, extra={"device": device_uuid, "sampled": True})
 
     def is_device_online(self, device_uuid):
-        return self.device_statuses.get(device_uuid, False)
-
-    def update_last_seen_online(self, device_uuid: str):
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "UPDATE clients SET last_seen_online = ? WHERE uuid = ?",
-                (datetime.utcnow(), device_uuid)
-            )
-            conn.commit()
+        return self.presence.is_online(device_uuid)
+
+    def payload_format(self, device_uuid):
+        return min(self.presence.payload_format(device_uuid), self.max_payload_format)
 
     def get_last_seen_online(self, device_uuid: str):
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT last_seen_online FROM clients WHERE uuid=?", (device_uuid,))
-            row = cursor.fetchone()
-            if row and row[0]:
-                try:
-                    return datetime.fromisoformat(row[0])
-                except ValueError:
-                    return None
-        return None
-
-    def send(self, message_title, message_body, recipient_uuid, public_key_pem, collapse_duplicates):
-        payload = self.create_payload(public_key_pem, message_title, message_body, collapse_duplicates)
+        return self.client_directory.get_last_seen_online(device_uuid)
 
+    async def publish_async(self, recipient_uuid, payload):
+        """
+        Publish a notification with QoS 1 on the recipient's connection and await the broker's
+        PUBACK without blocking the event loop, so concurrent publishes overlap their round-trips.
+        """
         topic = f"notifications/{recipient_uuid}"
-        print(f"MQTT Publish to {topic}")
-        info = self.client.publish(topic, payload, qos=1)
-        info.wait_for_publish()
+        shard = self.shard_for(recipient_uuid)
+
+        logger.debug("MQTT publish", extra={"topic": topic, "sampled": True})
+        with PUBLISH_SECONDS.time():
+            info = self.clients[shard].publish(topic, payload, qos=1)
+        # While reconnecting, paho keeps QoS 1 messages and sends them once the connection is back,
+        # so a short broker hiccup costs latency rather than a failed notification.
+        if info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+            logger.error("MQTT publish failed: %s", info.rc, extra={"topic": topic})
+            return False
 
-        if info.rc == mqtt.MQTT_ERR_SUCCESS:
-            print("MQTT message published successfully")
-            return True
-        else:
-            print(f"MQTT publish failed: {info.rc}")
+        # Registered before the next await, so the PUBACK callback scheduled by
+        # on_publish can never run ahead of it.
+        key = (shard, info.mid)
+        future = self.loop.create_future()
+        self.pending_publishes[key] = future
+        PUBLISHES_IN_FLIGHT.inc()
+        try:
+            with PUBACK_WAIT_SECONDS.time():
+                success = await asyncio.wait_for(future, self.publish_timeout)
+        except asyncio.TimeoutError:
+            logger.error("MQTT publish timed out waiting for PUBACK", extra={"topic": topic, "mid": info.mid})
             return False
+        finally:
+            PUBLISHES_IN_FLIGHT.dec()
+            self.pending_publishes.pop(key, None)
 
-    def send_encrypted(self, encrypted_title, encrypted_body, recipient_uuid, public_key_pem, collapse_duplicates):
-        payload = self.create_encrypted_payload(public_key_pem, encrypted_title, encrypted_body, collapse_duplicates)
+        if success:
+            logger.debug("MQTT message published", extra={"topic": topic, "mid": info.mid, "sampled": True})
+        else:
+            logger.error("MQTT publish rejected by broker", extra={"topic": topic, "mid": info.mid})
+        return success
+
+    def start_outbox_drain(self, device_uuid):
+        """Replay a device's queued notifications. Safe to call from any thread; a no-op unless leader."""
+        if self.is_leader and self.outbox.has_pending(device_uuid):
+            self.loop.call_soon_threadsafe(self._start_outbox_drain, device_uuid)
+
+    def _start_outbox_drain(self, device_uuid):
+        if device_uuid in self.draining_devices:
+            # The running drain re-checks the outbox before it finishes.
+            return
+        self.draining_devices.add(device_uuid)
+        asyncio.ensure_future(self.drain_outbox(device_uuid))
+
+    async def drain_outbox(self, device_uuid):
+        """
+        Publish a device's queued notifications in order, removing each once the broker has it.
+        Stops early if the device goes offline again; the rest stays queued.
+        """
+        try:
+            while self.is_device_online(device_uuid):
+                entries = await self.outbox.pending(device_uuid)
+                if not entries:
+                    return
 
-        topic = f"notifications/{recipient_uuid}"
-        print(f"MQTT Publish to {topic}")
-        info = self.client.publish(topic, payload, qos=1)
-        info.wait_for_publish()
+                logger.info("Replaying %d queued notifications", len(entries), extra={"device": device_uuid})
+                for entry_id, payload in entries:
+                    if not self.is_device_online(device_uuid) or not await self.publish_async(device_uuid, payload):
+                        return
+                    await self.outbox.remove(entry_id)
+        except Exception as e:
+            logger.error("Failed to replay queued notifications: %s", e, extra={"device": device_uuid})
+        finally:
+            self.draining_devices.discard(device_uuid)
+
+    async def create_payload_async(self, message_title, message_body, recipient_uuid, public_key_pem, collapse_duplicates, payload_format=PAYLOAD_FORMAT_RSA):
+        with ENCRYPTION_SECONDS.time():
+            return await self.encryption_pool.create_payload(
+                self.payload_builder, recipient_uuid, public_key_pem, message_title, message_body, collapse_duplicates, payload_format
+            )
 
-        if info.rc == mqtt.MQTT_ERR_SUCCESS:
-            print("MQTT message published successfully")
-            return True
-        else:
-            print(f"MQTT publish failed: {info.rc}")
-            return False
+    def create_encrypted_payload(self, encrypted_title, encrypted_body, recipient_uuid, public_key_pem, collapse_duplicates):
+        # Only the item id is encrypted here; the title and body arrive encrypted.
+        with ENCRYPTION_SECONDS.time():
+            return self.payload_builder.create_encrypted_payload(
+                recipient_uuid, public_key_pem, encrypted_title, encrypted_body, collapse_duplicates
+            )
+
+    async def send_async(self, message_title, message_body, recipient_uuid, public_key_pem, collapse_duplicates, payload_format=PAYLOAD_FORMAT_RSA):
+        payload = await self.create_payload_async(message_title, message_body, recipient_uuid, public_key_pem, collapse_duplicates, payload_format)
+        return await self.publish_async(recipient_uuid, payload)
+
+    async def send_encrypted_async(self, encrypted_title, encrypted_body, recipient_uuid, public_key_pem, collapse_duplicates):
+        payload = self.create_encrypted_payload(encrypted_title, encrypted_body, recipient_uuid, public_key_pem, collapse_duplicates)
+        return await self.publish_async(recipient_uuid, payload)
 
     def disconnect(self):
-        self.client.loop_stop()
-        self.client.disconnect()
+        if self._leader_task is not None:
+            self._leader_task.cancel()
+        if self._sweep_task is not None:
+            self._sweep_task.cancel()
+        for client in self.clients:
+            client.loop_stop()
+            client.disconnect()
+        self.status_pipeline.stop()
+        if self.leader_lock is not None:
+            self.leader_lock.release()
@@ -1,96 +1,243 @@
 from notifications.mqtt_notifier import MQTTNotification
+from notifications.client_directory import ClientDirectory
+from notifications.encryption_pool import EncryptionPool
+from notifications.outbox import Outbox
+from notifications.coalescer import Coalescer
+from notifications.presence import LocalPresenceStore, SharedPresenceStore
+from notifications.leader import LeaderLock
+from notifications.metrics import LOOKUP_SECONDS
+from notifications.payload import PAYLOAD_FORMAT_HYBRID, PAYLOAD_FORMAT_RSA
+from util.validate import Validate
+import asyncio
+import logging
 import os
-import sqlite3
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+
+def _runtime_path(name):
+    """
+    Default location of a node-local file shared by the API workers: $XDG_RUNTIME_DIR/pingberry
+    (tmpfs, private to this user) if set, otherwise the working directory, next to the default
+    database. Never a world-writable directory such as /tmp or /dev/shm.
+    """
+    runtime_dir = os.getenv("XDG_RUNTIME_DIR")
+    if not runtime_dir:
+        return os.path.abspath(name)
+    directory = os.path.join(runtime_dir, "pingberry")
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    return os.path.join(directory, name)
+
 
 class NotificationService:
-    def __init__(self, db_path=None):
-        self.db_path = db_path or os.getenv("DB_PATH", "notification.db")
+    def __init__(self, session_factory):
+        # "shared" lets several API workers on one node share device presence, with one
+        # elected worker subscribing to statuses.
+        shared = os.getenv("PRESENCE_STORE", "local") == "shared"
+        if shared:
+            presence = SharedPresenceStore(os.getenv("PRESENCE_DB_PATH") or _runtime_path("pingberry-presence.db"))
+            leader_lock = LeaderLock(os.getenv("STATUS_LEADER_LOCK") or _runtime_path("pingberry-status-leader.lock"))
+        else:
+            presence = LocalPresenceStore()
+            leader_lock = None
+
+        self.client_directory = ClientDirectory(
+            session_factory,
+            flush_interval=float(os.getenv("LAST_SEEN_FLUSH_INTERVAL", "5")),
+            flush_size=int(os.getenv("LAST_SEEN_FLUSH_SIZE", "500")),
+        )
+        self.outbox = Outbox(
+            session_factory, max_per_device=int(os.getenv("OUTBOX_MAX_PER_DEVICE", "100")), shared=shared
+        )
+
+        self.coalescer = Coalescer(window_seconds=float(os.getenv("COALESCE_WINDOW_SECONDS", "0")))
+
+        key_cache_size = int(os.getenv("KEY_CACHE_SIZE", "10000"))
+        session_key_max_age = float(os.getenv("SESSION_KEY_MAX_AGE", "86400"))
+        session_key_max_messages = int(os.getenv("SESSION_KEY_MAX_MESSAGES", "1000"))
+        self.encryption_pool = EncryptionPool(
+            workers=int(os.getenv("ENCRYPTION_WORKERS", "0")),
+            key_cache_size=key_cache_size,
+            session_key_max_age=session_key_max_age,
+            session_key_max_messages=session_key_max_messages,
+        )
 
         self.mqtt_notifier = MQTTNotification(
-            db_path=self.db_path,
+            client_directory=self.client_directory,
+            outbox=self.outbox,
             broker=os.getenv("MQTT_BROKER"),
             port=int(os.getenv("MQTT_PORT", "8883")),
             ca_cert=os.getenv("MQTT_CA_CERT"),
             username=os.getenv("MQTT_USERNAME"),
             password=os.getenv("MQTT_PASSWORD"),
+            encryption_pool=self.encryption_pool,
+            publish_timeout=float(os.getenv("MQTT_PUBLISH_TIMEOUT", "30")),
+            key_cache_size=key_cache_size,
+            status_workers=int(os.getenv("STATUS_WORKERS", "4")),
+            publisher_connections=int(os.getenv("MQTT_PUBLISHER_CONNECTIONS", "1")),
+            presence=presence,
+            leader_lock=leader_lock,
+            presence_grace_period=float(os.getenv("PRESENCE_GRACE_SECONDS", "30")),
+            session_keys=os.getenv("SESSION_KEYS", "false").lower() in ("1", "true", "yes"),
+            session_key_max_age=session_key_max_age,
+            session_key_max_messages=session_key_max_messages,
         )
 
-    def get_client_info(self, recipient_email: str):
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT uuid, notification_public_key FROM clients WHERE email=?",
-                (recipient_email,),
-            )
-            row = cursor.fetchone()
-            if row:
-                return {
-                    "uuid": row[0],
-                    "notification_public_key": row[1],
-                }
-        return None
+    async def start(self):
+        # Load state before connecting so the first status messages find their keys.
+        await self.client_directory.load()
+        await self.outbox.load()
+        self.client_directory.start_last_seen_writer()
+        self.mqtt_notifier.start()
+
+    async def close(self):
+        # Notifications held in a coalescing window were already accepted; send them while connected.
+        await self.coalescer.flush()
+        self.mqtt_notifier.disconnect()
+        # Write out any buffered last_seen_online updates before the engine goes away.
+        await self.client_directory.stop_last_seen_writer()
+        self.encryption_pool.shutdown()
+
+    async def get_client_info(self, recipient_email: str):
+        with LOOKUP_SECONDS.time():
+            client_info = self.client_directory.get_by_email(recipient_email)
+            if client_info is None:
+                # May have registered through another API worker.
+                await self.client_directory.reload(emails=[recipient_email])
+                client_info = self.client_directory.get_by_email(recipient_email)
+        return client_info
+
+    def client_registered(self, uuid: str, email: str, notification_public_key: str, status_public_key: str):
+        """Keep in-memory client state coherent after a /register write."""
+        self.client_directory.put(uuid, email, notification_public_key, status_public_key)
+        # Drop any parsed keys cached for this uuid so the new row's keys are used.
+        self.mqtt_notifier.key_cache.invalidate(uuid)
+        self.mqtt_notifier.payload_builder.session_keys.invalidate(uuid)
 
     async def send_notification(self, recipient_email: str, message_title: str, message_body: str, queue_if_offline: bool, collapse_duplicates: bool):
         """
         Automatically selects the delivery method (currently only MQTT supported) based on device status.
         `to` is the device UUID.
         """
-        client_info = self.get_client_info(recipient_email)
+        client_info = await self.get_client_info(recipient_email)
         if not client_info:
             # No client found in DB
-            print(f"[WARN] Client info for {recipient_email} not found.")
+            logger.warning("Notification recipient not found", extra={"recipient_email": recipient_email})
             return {"method": None, "status": "fail", "code": 404, "error": f"Notification recipient {recipient_email} not found"}
 
+        return await self.deliver_notification(client_info, message_title, message_body, queue_if_offline, collapse_duplicates)
+
+    async def send_batch_notification(self, recipient_emails: list, message_title: str, message_body: str, queue_if_offline: bool, collapse_duplicates: bool):
+        """
+        Fan the same notification out to many recipients. Recipients are resolved in one pass,
+        and every delivery runs concurrently so encryption and broker round-trips overlap.
+        Returns one result per unique recipient, in request order.
+        """
+        recipient_emails = list(dict.fromkeys(recipient_emails))
+        with LOOKUP_SECONDS.time():
+            clients = self.client_directory.get_many_by_email(recipient_emails)
+            missing = [email for email in recipient_emails if email not in clients]
+            if missing:
+                await self.client_directory.reload(emails=missing)
+                clients.update(self.client_directory.get_many_by_email(missing))
+
+        async def deliver(recipient_email):
+            client_info = clients.get(recipient_email)
+            if not client_info:
+                result = {"method": None, "status": "fail", "code": 404, "error": f"Notification recipient {recipient_email} not found"}
+            else:
+                result = await self.deliver_notification(client_info, message_title, message_body, queue_if_offline, collapse_duplicates)
+            return {"recipient_email": recipient_email, **result}
+
+        return await asyncio.gather(*(deliver(email) for email in recipient_emails))
+
+    async def deliver_notification(self, client_info: dict, message_title: str, message_body: str, queue_if_offline: bool, collapse_duplicates: bool):
         recipient_uuid = client_info["uuid"]
         notif_public_key_pem = client_info["notification_public_key"]
 
+        payload_format = self.mqtt_notifier.payload_format(recipient_uuid)
+        if payload_format == PAYLOAD_FORMAT_RSA and max(len(message_title.encode()), len(message_body.encode())) > Validate.MAX_FIELD_SIZE:
+            return {
+                "method": None, "status": "fail", "code": 400,
+                "error": f"Recipient's device only accepts titles and bodies of at most {Validate.MAX_FIELD_SIZE} bytes",
+            }
+
         try:
             if self.mqtt_notifier.is_device_online(recipient_uuid):
-                print(f"[INFO] Device {recipient_uuid} online → sending via MQTT.")
-                success = self.mqtt_notifier.send(
-                    message_title, message_body, recipient_uuid, notif_public_key_pem, collapse_duplicates
+                logger.debug("Device online; sending via MQTT", extra={"device": recipient_uuid})
+                send = lambda: self.mqtt_notifier.send_async(
+                    message_title, message_body, recipient_uuid, notif_public_key_pem, collapse_duplicates, payload_format
                 )
+                if self.hold_for_coalescing(recipient_uuid, message_title, collapse_duplicates, send):
+                    return {"method": "mqtt", "status": "success", "code": 202, "coalesced": True}
+
+                success = await send()
                 if success:
                     return {"method": "mqtt", "status": "success", "code": 200}
                 else:
                     return {"method": "mqtt", "status": "fail", "code": 500, "error": "MQTT send failed"}
             else:
                 if queue_if_offline:
-                    print(f"[INFO] Queuing message for {recipient_uuid} until device comes online")
-                    success = self.mqtt_notifier.send(
-                        message_title, message_body, recipient_uuid, notif_public_key_pem, collapse_duplicates
+                    logger.debug("Queuing notification until device comes online", extra={"device": recipient_uuid})
+                    payload = await self.mqtt_notifier.create_payload_async(
+                        message_title, message_body, recipient_uuid, notif_public_key_pem, collapse_duplicates, payload_format
                     )
-                    if success:
-                        return {"method": "mqtt", "status": "success", "code": 202}
-                    else:
-                        return {"method": "mqtt", "status": "fail", "code": 500, "error": "MQTT queue failed"}
+                    collapse_key = Outbox.collapse_key(message_title) if collapse_duplicates else None
+                    await self.queue_notification(recipient_uuid, payload, collapse_key)
+                    return {"method": "mqtt", "status": "success", "code": 202}
 
                 return {"method": None, "status": "fail", "code": 409, "error": "Device offline"}
 
         except Exception as e:
-            print(f"[ERROR] Notification send failed: {e}")
+            logger.exception("Notification send failed", extra={"device": recipient_uuid})
             return {"method": None, "status": "fail", "code": 500, "error": str(e)}
 
-    async def send_encrypted_notification(self, recipient_email: str, encrypted_title: str, encrypted_body: str, queue_if_offline: bool, collapse_duplicates: bool):
-        client_info = self.get_client_info(recipient_email)
+    def hold_for_coalescing(self, recipient_uuid: str, title: str, collapse_duplicates: bool, send):
+        """
+        Returns True if `send` was held by the coalescing window (to be sent, or superseded, later)
+        and must not be sent now.
+        """
+        if not collapse_duplicates or not self.coalescer.enabled:
+            return False
+        if self.coalescer.submit((recipient_uuid, Outbox.collapse_key(title)), send):
+            return False
+
+        logger.debug("Holding duplicate notification in coalescing window", extra={"device": recipient_uuid})
+        return True
+
+    async def queue_notification(self, recipient_uuid: str, payload: str, collapse_key):
+        await self.outbox.enqueue(recipient_uuid, payload, collapse_key)
+
+        # The device may have come online while this was being queued. Only the status leader
+        # replays outboxes; elsewhere this is a no-op and the leader's outbox sweep picks it up.
+        if self.mqtt_notifier.is_device_online(recipient_uuid):
+            self.mqtt_notifier.start_outbox_drain(recipient_uuid)
+
+    async def send_encrypted_notification(self, recipient_email: str, encrypted_title: str, encrypted_body: str, queue_if_offline: bool, collapse_duplicates: bool, encrypted_payload: str = None):
+        client_info = await self.get_client_info(recipient_email)
         if not client_info:
             # No client found in DB
-            print(f"[WARN] Client info for {recipient_email} not found.")
+            logger.warning("Notification recipient not found", extra={"recipient_email": recipient_email})
             return {"method": None, "status": "fail", "code": 404, "error": f"Notification recipient {recipient_email} not found"}
 
         recipient_uuid = client_info["uuid"]
         notif_public_key_pem = client_info["notification_public_key"]
 
+        if encrypted_payload is not None:
+            return await self.deliver_encrypted_payload(recipient_uuid, encrypted_payload, queue_if_offline)
+
+        # RSA (PKCS#1 v1.5) padding is random, so the same title never encrypts to the same
+        # ciphertext twice: the server can't tell duplicates apart, and neither coalesces nor
+        # collapses queued entries here. The device still collapses them by title.
         try:
             if self.mqtt_notifier.is_device_online(recipient_uuid):
-                print(f"[INFO] Device {recipient_uuid} online → sending via MQTT.")
-                success = self.mqtt_notifier.send_encrypted(
-                    encrypted_title, encrypted_body, recipient_uuid, notif_public_key_pem,collapse_duplicates
+                logger.debug("Device online; sending via MQTT", extra={"device": recipient_uuid})
+                success = await self.mqtt_notifier.send_encrypted_async(
+                    encrypted_title, encrypted_body, recipient_uuid, notif_public_key_pem, collapse_duplicates
                 )
                 if success:
                     return {"method": "mqtt", "status": "success", "code": 200}
@@ -98,17 +245,40 @@ class NotificationService:
                     return {"method": "mqtt", "status": "fail", "code": 500, "error": "MQTT send failed"}
             else:
                 if queue_if_offline:
-                    print(f"[INFO] Queuing message for {recipient_uuid} until device comes online")
-                    success = self.mqtt_notifier.send_encrypted(
+                    logger.debug("Queuing notification until device comes online", extra={"device": recipient_uuid})
+                    payload = self.mqtt_notifier.create_encrypted_payload(
                         encrypted_title, encrypted_body, recipient_uuid, notif_public_key_pem, collapse_duplicates
                     )
-                    if success:
-                        return {"method": "mqtt", "status": "success", "code": 202}
-                    else:
-                        return {"method": "mqtt", "status": "fail", "code": 500, "error": "MQTT queue failed"}
+                    await self.queue_notification(recipient_uuid, payload, None)
+                    return {"method": "mqtt", "status": "success", "code": 202}
 
                 return {"method": None, "status": "fail", "code": 409, "error": "Device offline"}
 
         except Exception as e:
-            print(f"[ERROR] Notification send failed: {e}")
-            return {"method": None, "status": "fail", "code": 500, "error": str(e)}
\ No newline at end of file
+            logger.exception("Notification send failed", extra={"device": recipient_uuid})
+            return {"method": None, "status": "fail", "code": 500, "error": str(e)}
+
+    async def deliver_encrypted_payload(self, recipient_uuid: str, encrypted_payload: str, queue_if_offline: bool):
+        """
+        Deliver a payload the sender built in format 2. It is published as-is; collapsing is up to
+        the itemid the sender put inside it, since the server cannot see the title.
+        """
+        if self.mqtt_notifier.payload_format(recipient_uuid) < PAYLOAD_FORMAT_HYBRID:
+            return {"method": None, "status": "fail", "code": 409, "error": "Recipient's device does not accept payload format 2"}
+
+        try:
+            if self.mqtt_notifier.is_device_online(recipient_uuid):
+                if await self.mqtt_notifier.publish_async(recipient_uuid, encrypted_payload):
+                    return {"method": "mqtt", "status": "success", "code": 200}
+                return {"method": "mqtt", "status": "fail", "code": 500, "error": "MQTT send failed"}
+
+            if queue_if_offline:
+                logger.debug("Queuing notification until device comes online", extra={"device": recipient_uuid})
+                await self.queue_notification(recipient_uuid, encrypted_payload, None)
+                return {"method": "mqtt", "status": "success", "code": 202}
+
+            return {"method": None, "status": "fail", "code": 409, "error": "Device offline"}
+
+        except Exception as e:
+            logger.exception("Notification send failed", extra={"device": recipient_uuid})
+            return {"method": None, "status": "fail", "code": 500, "error": str(e)}
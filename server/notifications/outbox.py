@@ -0,0 +1,129 @@
+from contextlib import asynccontextmanager
+from datetime import datetime
+from sqlalchemy import bindparam, delete, insert, select
+from schemas import OutboxEntry
+import asyncio
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Hot statements are built once, so SQLAlchemy's compiled cache and SQLite's
+# per-connection statement cache keep reusing the same prepared statement.
+DELETE_COLLAPSED = delete(OutboxEntry).where(
+    OutboxEntry.device_uuid == bindparam("device_uuid"),
+    OutboxEntry.collapse_key == bindparam("key"),
+)
+INSERT_ENTRY = insert(OutboxEntry)
+DELETE_OVERFLOW = delete(OutboxEntry).where(
+    OutboxEntry.device_uuid == bindparam("device_uuid"),
+    OutboxEntry.id.not_in(
+        select(OutboxEntry.id)
+        .where(OutboxEntry.device_uuid == bindparam("device_uuid"))
+        .order_by(OutboxEntry.id.desc())
+        .limit(bindparam("keep"))
+    ),
+)
+SELECT_PENDING = (
+    select(OutboxEntry.id, OutboxEntry.payload)
+    .where(OutboxEntry.device_uuid == bindparam("device_uuid"))
+    .order_by(OutboxEntry.id)
+)
+DELETE_ENTRY = delete(OutboxEntry).where(OutboxEntry.id == bindparam("entry_id"))
+
+
+class Outbox:
+    """
+    Durable per-device queue of notifications waiting for an offline device.
+    Entries are appended in order and replayed when the device comes back online.
+
+    Queuing with a collapse key drops any older entry with the same key for that device,
+    so a device that was away for a week gets one notification per title instead of all of them.
+    Each device keeps at most `max_per_device` entries; the oldest are dropped first.
+
+    With `shared` set, other API workers queue into the same table, so the in-memory set of
+    devices with queued entries is incomplete and the table is always checked.
+
+    All methods must be called from the event loop thread.
+    """
+
+    def __init__(self, session_factory, max_per_device=100, shared=False):
+        self.session_factory = session_factory
+        self.max_per_device = max_per_device
+        self.shared = shared
+        self._pending_devices = set()  # uuids with at least one queued entry
+        self._locks = {}  # device_uuid -> [asyncio.Lock, users], only while in use
+
+    @staticmethod
+    def collapse_key(title: str) -> str:
+        # Only a digest of the title is stored, never the title itself.
+        return hashlib.sha256(title.encode()).hexdigest()
+
+    async def queued_devices(self) -> set:
+        """Devices with at least one queued entry, read from the table."""
+        async with self.session_factory() as session:
+            result = await session.execute(select(OutboxEntry.device_uuid).distinct())
+            return set(result.scalars().all())
+
+    @asynccontextmanager
+    async def _device_lock(self, device_uuid: str):
+        """
+        Serializes queuing and reading for one device, so `_pending_devices` agrees with the
+        table; other devices are never held up by it.
+        """
+        entry = self._locks.get(device_uuid)
+        if entry is None:
+            entry = self._locks[device_uuid] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[device_uuid]
+
+    async def load(self):
+        self._pending_devices = await self.queued_devices()
+        logger.info("Outbox has queued notifications for %d devices", len(self._pending_devices))
+
+    async def enqueue(self, device_uuid: str, payload: str, collapse_key=None):
+        async with self._device_lock(device_uuid), self.session_factory() as session:
+            if collapse_key is not None:
+                await session.execute(DELETE_COLLAPSED, {"device_uuid": device_uuid, "key": collapse_key})
+            await session.execute(
+                INSERT_ENTRY,
+                {
+                    "device_uuid": device_uuid,
+                    "collapse_key": collapse_key,
+                    "payload": payload,
+                    "queued_at": datetime.utcnow(),
+                },
+            )
+            # Keep only the newest max_per_device entries for this device.
+            await session.execute(DELETE_OVERFLOW, {"device_uuid": device_uuid, "keep": self.max_per_device})
+            await session.commit()
+            self._pending_devices.add(device_uuid)
+
+    def has_pending(self, device_uuid: str) -> bool:
+        return self.shared or device_uuid in self._pending_devices
+
+    async def pending(self, device_uuid: str):
+        """Return queued (id, payload) entries for a device, oldest first."""
+        if not self.has_pending(device_uuid):
+            return []
+
+        async with self._device_lock(device_uuid), self.session_factory() as session:
+            result = await session.execute(SELECT_PENDING, {"device_uuid": device_uuid})
+            entries = result.all()
+            if not entries:
+                self._pending_devices.discard(device_uuid)
+            return entries
+
+    async def remove(self, entry_id: int):
+        async with self.session_factory() as session:
+            await session.execute(DELETE_ENTRY, {"entry_id": entry_id})
+            await session.commit()
+
+    def pending_device_count(self) -> int:
+        return len(self._pending_devices)
@@ -0,0 +1,137 @@
+from Crypto.Cipher import ChaCha20_Poly1305
+from Crypto.Random import get_random_bytes
+from notifications.session_keys import SessionKeyCache
+import base64
+import json
+import random
+import string
+
+# Payload formats, advertised by devices in their signed status.
+# 1: itemid, title and subtitle each RSA-encrypted (fields limited to 245 bytes).
+# 2: one RSA-wrapped ChaCha20-Poly1305 key encrypting the whole notification.
+# 3: like 2, but the key is a per-device session key reused across notifications (opt-in).
+PAYLOAD_FORMAT_RSA = 1
+PAYLOAD_FORMAT_HYBRID = 2
+PAYLOAD_FORMAT_SESSION = 3
+SUPPORTED_PAYLOAD_FORMATS = (PAYLOAD_FORMAT_RSA, PAYLOAD_FORMAT_HYBRID, PAYLOAD_FORMAT_SESSION)
+
+
+class PayloadBuilder:
+    """
+    Builds the JSON payloads published to `notifications/<uuid>`.
+    Kept free of any MQTT state so it can also run inside encryption worker processes.
+    """
+
+    def __init__(self, key_cache, session_keys=None):
+        self.key_cache = key_cache
+        self.session_keys = session_keys or SessionKeyCache(max_size=key_cache.max_size)
+
+    def encrypt_bytes(self, device_uuid: str, public_key_pem: str, data: bytes) -> str:
+        cipher = self.key_cache.get_cipher(device_uuid, public_key_pem)
+        return base64.b64encode(cipher.encrypt(data)).decode()
+
+    def encrypt_message(self, device_uuid: str, public_key_pem: str, message: str) -> str:
+        return self.encrypt_bytes(device_uuid, public_key_pem, message.encode())
+
+    def generate_message_id(self):
+        return ''.join(random.choices(string.ascii_letters + string.digits, k=10))
+
+    def create_payload(self, recipient_uuid, public_key_pem, message_title, message_body, collapse_duplicates, payload_format=PAYLOAD_FORMAT_RSA):
+        if payload_format == PAYLOAD_FORMAT_SESSION:
+            return self.create_session_payload(recipient_uuid, public_key_pem, message_title, message_body, collapse_duplicates)
+        if payload_format == PAYLOAD_FORMAT_HYBRID:
+            return self.create_hybrid_payload(recipient_uuid, public_key_pem, message_title, message_body, collapse_duplicates)
+
+        message_title_encrypted = self.encrypt_message(recipient_uuid, public_key_pem, message_title)
+
+        if collapse_duplicates:
+            # Replace any existing notification with the same title.
+            item_id_encrypted = message_title_encrypted
+        else:
+            # Create unique notification.
+            item_id_encrypted = self.encrypt_message(recipient_uuid, public_key_pem, self.generate_message_id())
+        
+        payload_dict = {
+            "itemid": item_id_encrypted,
+            "title": message_title_encrypted,
+            "subtitle": self.encrypt_message(recipient_uuid, public_key_pem, message_body),
+            # "target": "defaultTarget",
+            # "targetAction": "defaultTargetAction",
+            # "payload": "defaultPayload",
+            # "payloadType": "defaultPayloadType",
+            # "payloadURI": "defaultPayloadURI"
+        }
+        return json.dumps(payload_dict)
+
+    def create_encrypted_payload(self, recipient_uuid, public_key_pem, encrypted_title, encrypted_body, collapse_duplicates):
+        if collapse_duplicates:
+            # Replace any existing notification with the same title.
+            item_id_encrypted = encrypted_title
+        else:
+            # Create unique notification.
+            item_id_encrypted = self.encrypt_message(recipient_uuid, public_key_pem, self.generate_message_id())
+        
+        payload_dict = {
+            "itemid": item_id_encrypted,
+            "title": encrypted_title,
+            "subtitle": encrypted_body,
+            # "target": "defaultTarget",
+            # "targetAction": "defaultTargetAction",
+            # "payload": "defaultPayload",
+            # "payloadType": "defaultPayloadType",
+            # "payloadURI": "defaultPayloadURI"
+        }
+        return json.dumps(payload_dict)
+
+    def create_hybrid_payload(self, recipient_uuid, public_key_pem, message_title, message_body, collapse_duplicates):
+        """
+        Format 2: a fresh ChaCha20-Poly1305 key encrypts the whole notification and is itself
+        RSA-encrypted, so each notification costs one RSA operation and fields can be longer.
+        """
+        key = get_random_bytes(32)
+        nonce, data = self.seal(key, message_title, message_body, collapse_duplicates)
+
+        return json.dumps({
+            "v": PAYLOAD_FORMAT_HYBRID,
+            "key": self.encrypt_bytes(recipient_uuid, public_key_pem, key),
+            "nonce": nonce,
+            "data": data,
+        })
+
+    def create_session_payload(self, recipient_uuid, public_key_pem, message_title, message_body, collapse_duplicates):
+        """
+        Format 3: the notification is encrypted with the device's current session key, so the
+        steady state needs no RSA at all. The wrapped key travels with every message (queued
+        messages may outlive the device's key cache); devices only unwrap a `kid` they haven't seen.
+        """
+        key_id, key, wrapped_key = self.session_keys.acquire(
+            recipient_uuid, public_key_pem, lambda new_key: self.encrypt_bytes(recipient_uuid, public_key_pem, new_key)
+        )
+        # The key id is authenticated, so a message can't be passed off under another session.
+        nonce, data = self.seal(key, message_title, message_body, collapse_duplicates, aad=key_id.encode())
+
+        return json.dumps({
+            "v": PAYLOAD_FORMAT_SESSION,
+            "kid": key_id,
+            "key": wrapped_key,
+            "nonce": nonce,
+            "data": data,
+        })
+
+    def seal(self, key, message_title, message_body, collapse_duplicates, aad=None):
+        """Encrypt the notification with ChaCha20-Poly1305; returns base64 (nonce, ciphertext + tag)."""
+        notification = {
+            # Collapsing replaces any existing notification with the same title.
+            "itemid": message_title if collapse_duplicates else self.generate_message_id(),
+            "title": message_title,
+            "subtitle": message_body,
+        }
+
+        # Random nonces are safe here: a session key encrypts at most a few thousand messages.
+        nonce = get_random_bytes(12)
+        cipher = ChaCha20_Poly1305.new(key=key, nonce=nonce)
+        if aad:
+            cipher.update(aad)
+        plaintext = json.dumps(notification, ensure_ascii=False, separators=(",", ":")).encode()
+        ciphertext, tag = cipher.encrypt_and_digest(plaintext)
+        return base64.b64encode(nonce).decode(), base64.b64encode(ciphertext + tag).decode()
@@ -0,0 +1,258 @@
+from array import array
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+def _device_key(device_uuid: str) -> bytes:
+    # 16 raw bytes instead of a 36 character string.
+    return uuid.UUID(device_uuid).bytes
+
+
+def _get_bit(bits: bytearray, index: int) -> bool:
+    return bool(bits[index >> 3] & (1 << (index & 7)))
+
+
+def _set_bit(bits: bytearray, index: int, value: bool):
+    if value:
+        bits[index >> 3] |= 1 << (index & 7)
+    else:
+        bits[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+
+
+class LocalPresenceStore:
+    """
+    Online/offline state of devices, held in this process.
+    Enough when a single API worker handles both statuses and notifications.
+
+    Devices live in an open-addressing table of flat arrays rather than a dict: the slot of a
+    device holds its 16 uuid bytes, a bit for its online state, a 32-bit time of its last
+    status, the payload format it accepts and a 16-byte digest of its last verified status,
+    so no Python object is created per device and memory is about 40 bytes per slot.
+    The number of online devices is kept up to date as states change.
+    """
+
+    INITIAL_CAPACITY = 1024  # slots; always a power of two
+    MAX_LOAD = 0.7
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._allocate(self.INITIAL_CAPACITY)
+        self._online_count = 0
+
+    def _allocate(self, capacity):
+        self._capacity = capacity
+        self._size = 0
+        self._keys = bytearray(capacity * 16)
+        self._used = bytearray(capacity // 8)
+        self._online_bits = bytearray(capacity // 8)
+        self._last_seen = array("I", bytes(capacity * 4))  # unix seconds of the last status
+        self._payload_formats = bytearray(capacity)
+        self._status_digests = bytearray(capacity * 16)  # all zero: none recorded
+
+    def _find(self, key: bytes) -> int:
+        """Slot holding `key`, or the empty slot where it belongs."""
+        mask = self._capacity - 1
+        slot = hash(key) & mask
+        while _get_bit(self._used, slot):
+            if self._keys[slot * 16:slot * 16 + 16] == key:
+                return slot
+            slot = (slot + 1) & mask
+        return slot
+
+    def _grow(self):
+        keys, used, online_bits, last_seen = self._keys, self._used, self._online_bits, self._last_seen
+        payload_formats, status_digests = self._payload_formats, self._status_digests
+        self._allocate(self._capacity * 2)
+        for old_slot in range(len(last_seen)):
+            if _get_bit(used, old_slot):
+                key = bytes(keys[old_slot * 16:old_slot * 16 + 16])
+                slot = self._insert(key)
+                _set_bit(self._online_bits, slot, _get_bit(online_bits, old_slot))
+                self._last_seen[slot] = last_seen[old_slot]
+                self._payload_formats[slot] = payload_formats[old_slot]
+                self._status_digests[slot * 16:slot * 16 + 16] = status_digests[old_slot * 16:old_slot * 16 + 16]
+
+    def _insert(self, key: bytes) -> int:
+        slot = self._find(key)
+        self._keys[slot * 16:slot * 16 + 16] = key
+        _set_bit(self._used, slot, True)
+        self._size += 1
+        return slot
+
+    def _lookup(self, device_uuid: str):
+        try:
+            key = _device_key(device_uuid)
+        except ValueError:
+            return None
+        slot = self._find(key)
+        return slot if _get_bit(self._used, slot) else None
+
+    def set_online(self, device_uuid: str, online: bool, payload_format: int = 1, status_digest: bytes = None) -> bool:
+        """Record a device's state, and the digest of the status it came from, and return whether it was online before."""
+        key = _device_key(device_uuid)
+        with self._lock:
+            slot = self._find(key)
+            if not _get_bit(self._used, slot):
+                if self._size + 1 > self._capacity * self.MAX_LOAD:
+                    self._grow()
+                slot = self._insert(key)
+
+            was_online = _get_bit(self._online_bits, slot)
+            if online != was_online:
+                _set_bit(self._online_bits, slot, online)
+                self._online_count += 1 if online else -1
+            self._last_seen[slot] = int(time.time())
+            self._payload_formats[slot] = payload_format
+            self._status_digests[slot * 16:slot * 16 + 16] = status_digest or bytes(16)
+        return was_online
+
+    def is_online(self, device_uuid: str) -> bool:
+        with self._lock:
+            slot = self._lookup(device_uuid)
+            return slot is not None and _get_bit(self._online_bits, slot)
+
+    def last_seen(self, device_uuid: str):
+        """Unix time of the device's last status, or None if it hasn't reported one."""
+        with self._lock:
+            slot = self._lookup(device_uuid)
+            return self._last_seen[slot] if slot is not None else None
+
+    def payload_format(self, device_uuid: str) -> int:
+        """Newest payload format the device reported it accepts; 1 if it hasn't reported."""
+        with self._lock:
+            slot = self._lookup(device_uuid)
+            return self._payload_formats[slot] if slot is not None else 1
+
+    def status_digest(self, device_uuid: str):
+        """Digest passed with the device's last state, or None."""
+        with self._lock:
+            slot = self._lookup(device_uuid)
+            if slot is None:
+                return None
+            digest = bytes(self._status_digests[slot * 16:slot * 16 + 16])
+            return digest if any(digest) else None
+
+    def online_count(self) -> int:
+        return self._online_count
+
+    def expire_before(self, timestamp: int) -> int:
+        """Mark offline every online device whose last status is older than `timestamp`. Returns how many."""
+        expired = 0
+        with self._lock:
+            for byte_index, byte in enumerate(self._online_bits):
+                if not byte:
+                    continue
+                for bit in range(8):
+                    slot = byte_index * 8 + bit
+                    if byte & (1 << bit) and self._last_seen[slot] < timestamp:
+                        _set_bit(self._online_bits, slot, False)
+                        expired += 1
+            self._online_count -= expired
+        return expired
+
+    def clear(self):
+        with self._lock:
+            self._allocate(self.INITIAL_CAPACITY)
+            self._online_count = 0
+
+
+class SharedPresenceStore:
+    """
+    Online/offline state of devices in a SQLite file shared by every API worker on the node.
+    Only the status leader writes to it; the other workers read it before each delivery.
+
+    Presence is rebuilt from the broker's retained status messages whenever a leader
+    subscribes, so the file is not meant to be durable: put it on tmpfs (e.g. /dev/shm).
+    Devices are keyed by their 16 uuid bytes, and the number online is kept in a counter row
+    updated in the same transaction as each state change.
+    """
+
+    def __init__(self, path):
+        # Whoever can write the file decides which devices look online.
+        if os.path.lexists(path):
+            info = os.lstat(path)
+            if os.path.islink(path) or info.st_uid != os.getuid():
+                raise PermissionError(f"{path} is not a file owned by this user")
+        self.path = path
+        self._local = threading.local()  # one connection per thread
+        with self._connection() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS presence "
+                "(device BLOB PRIMARY KEY, online INTEGER NOT NULL, last_seen INTEGER NOT NULL, "
+                "payload_format INTEGER NOT NULL DEFAULT 1, status_digest BLOB) WITHOUT ROWID"
+            )
+            # A file left by an older version on the same tmpfs
+            if "status_digest" not in {row[1] for row in db.execute("PRAGMA table_info(presence)")}:
+                db.execute("ALTER TABLE presence ADD COLUMN status_digest BLOB")
+            db.execute("CREATE TABLE IF NOT EXISTS presence_count (id INTEGER PRIMARY KEY, online INTEGER NOT NULL)")
+            db.execute("INSERT OR IGNORE INTO presence_count (id, online) VALUES (0, 0)")
+
+    def _connection(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=OFF")
+            self._local.db = db
+        return db
+
+    def set_online(self, device_uuid: str, online: bool, payload_format: int = 1, status_digest: bytes = None) -> bool:
+        """Record a device's state, and the digest of the status it came from, and return whether it was online before."""
+        key = _device_key(device_uuid)
+        with self._connection() as db:
+            row = db.execute("SELECT online FROM presence WHERE device = ?", (key,)).fetchone()
+            was_online = bool(row and row[0])
+            db.execute(
+                "INSERT OR REPLACE INTO presence (device, online, last_seen, payload_format, status_digest) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, int(online), int(time.time()), payload_format, status_digest),
+            )
+            if online != was_online:
+                db.execute("UPDATE presence_count SET online = online + ? WHERE id = 0", (1 if online else -1,))
+        return was_online
+
+    def _select(self, column, device_uuid):
+        try:
+            key = _device_key(device_uuid)
+        except ValueError:
+            return None
+        return self._connection().execute(f"SELECT {column} FROM presence WHERE device = ?", (key,)).fetchone()
+
+    def is_online(self, device_uuid: str) -> bool:
+        row = self._select("online", device_uuid)
+        return bool(row and row[0])
+
+    def last_seen(self, device_uuid: str):
+        """Unix time of the device's last status, or None if it hasn't reported one."""
+        row = self._select("last_seen", device_uuid)
+        return row[0] if row else None
+
+    def payload_format(self, device_uuid: str) -> int:
+        """Newest payload format the device reported it accepts; 1 if it hasn't reported."""
+        row = self._select("payload_format", device_uuid)
+        return row[0] if row else 1
+
+    def status_digest(self, device_uuid: str):
+        """Digest passed with the device's last state, or None."""
+        row = self._select("status_digest", device_uuid)
+        return row[0] if row else None
+
+    def online_count(self) -> int:
+        return self._connection().execute("SELECT online FROM presence_count WHERE id = 0").fetchone()[0]
+
+    def expire_before(self, timestamp: int) -> int:
+        """Mark offline every online device whose last status is older than `timestamp`. Returns how many."""
+        with self._connection() as db:
+            expired = db.execute(
+                "UPDATE presence SET online = 0 WHERE online = 1 AND last_seen < ?", (timestamp,)
+            ).rowcount
+            db.execute("UPDATE presence_count SET online = online - ? WHERE id = 0", (expired,))
+        return expired
+
+    def clear(self):
+        with self._connection() as db:
+            db.execute("DELETE FROM presence")
+            db.execute("UPDATE presence_count SET online = 0 WHERE id = 0")
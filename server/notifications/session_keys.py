@@ -0,0 +1,77 @@
+from collections import OrderedDict
+from Crypto.Random import get_random_bytes
+import secrets
+import threading
+import time
+
+
+class _Session:
+    __slots__ = ("public_key_pem", "key_id", "key", "wrapped_key", "created", "messages")
+
+    def __init__(self, public_key_pem, key_id, key, wrapped_key):
+        self.public_key_pem = public_key_pem
+        self.key_id = key_id
+        self.key = key
+        self.wrapped_key = wrapped_key
+        self.created = time.monotonic()
+        self.messages = 0
+
+
+class SessionKeyCache:
+    """
+    Per-device ChaCha20-Poly1305 keys for payload format 3. A key is RSA-wrapped once, when it
+    is created, and reused until it is `max_age` seconds old or has encrypted `max_messages`
+    notifications. Bounded LRU, keyed by device uuid; a changed notification key starts a new session.
+    """
+
+    def __init__(self, max_size=10000, max_age=86400.0, max_messages=1000):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.max_messages = max_messages
+        self.rotations = 0
+        self._sessions = OrderedDict()  # device_uuid -> _Session
+        self._lock = threading.Lock()
+
+    def acquire(self, device_uuid: str, public_key_pem: str, wrap):
+        """
+        Returns (key_id, key, wrapped_key) for one more notification to the device.
+        `wrap(key)` RSA-encrypts a new key for the device; it is only called on rotation.
+        """
+        with self._lock:
+            session = self._sessions.get(device_uuid)
+            if session is not None and self._usable(session, public_key_pem):
+                session.messages += 1
+                self._sessions.move_to_end(device_uuid)
+                return session.key_id, session.key, session.wrapped_key
+
+        # Wrap outside the lock; concurrent rotations for one device just leave an unused key behind.
+        key = get_random_bytes(32)
+        session = _Session(public_key_pem, secrets.token_hex(8), key, wrap(key))
+        session.messages = 1
+
+        with self._lock:
+            self.rotations += 1
+            self._sessions[device_uuid] = session
+            self._sessions.move_to_end(device_uuid)
+            while len(self._sessions) > self.max_size:
+                self._sessions.popitem(last=False)
+        return session.key_id, session.key, session.wrapped_key
+
+    def _usable(self, session, public_key_pem):
+        return (
+            session.public_key_pem == public_key_pem
+            and session.messages < self.max_messages
+            and time.monotonic() - session.created < self.max_age
+        )
+
+    def invalidate(self, device_uuid: str):
+        with self._lock:
+            self._sessions.pop(device_uuid, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._sessions),
+                "max_size": self.max_size,
+                "rotations": self.rotations,
+            }
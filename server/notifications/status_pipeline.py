@@ -0,0 +1,106 @@
+import queue
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class StatusPipeline:
+    """
+    Moves status message handling (JSON parsing, key lookup, signature verification)
+    off paho's network thread onto a pool of worker threads.
+
+    Each device is pinned to one worker so its statuses are handled in order. A status
+    is state rather than an event, so while one is still waiting, a newer one for the same
+    device replaces it instead of queuing behind it. A device is therefore queued at most
+    once, which bounds the queues by the number of known devices. Their statuses are never
+    dropped: the broker only resends retained statuses on resubscription.
+
+    Anyone can publish to any status topic, so statuses for devices the caller doesn't know
+    (perhaps registered through another API worker) wait for at most `max_unknown` devices
+    at a time; beyond that they are dropped and counted.
+    """
+
+    def __init__(self, handler, workers=4, max_unknown=1000):
+        if workers < 1:
+            raise ValueError("StatusPipeline needs at least one worker")
+        self.handler = handler  # handler(device_uuid, payload: bytes)
+        self.workers = workers
+        self._queues = [queue.Queue() for _ in range(workers)]
+        self._latest = {}  # device_uuid -> newest payload not yet handled
+        self._unknown = set()  # waiting devices submitted as unknown
+        self.max_unknown = max_unknown
+        self._lock = threading.Lock()
+        self._threads = []
+
+        self.processed = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    def start(self):
+        for index, work_queue in enumerate(self._queues):
+            thread = threading.Thread(
+                target=self._work, args=(work_queue,), name=f"status-worker-{index}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        for work_queue in self._queues:
+            work_queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout=5)
+        self._threads = []
+
+    def submit(self, device_uuid: str, payload: bytes, known=True) -> bool:
+        """
+        Queue a status for handling; False if it was dropped (only for unknown devices).
+        Called on paho's network thread, so it never blocks.
+        """
+        with self._lock:
+            if device_uuid in self._latest:
+                self._latest[device_uuid] = payload
+                self.coalesced += 1
+                return True
+            if not known:
+                if len(self._unknown) >= self.max_unknown:
+                    self.dropped += 1
+                    return False
+                self._unknown.add(device_uuid)
+            self._latest[device_uuid] = payload
+
+        self._queues[hash(device_uuid) % self.workers].put(device_uuid)
+        self.max_depth = max(self.max_depth, self.depth())
+        return True
+
+    def _work(self, work_queue):
+        while True:
+            device_uuid = work_queue.get()
+            if device_uuid is None:
+                return
+
+            with self._lock:
+                payload = self._latest.pop(device_uuid, None)
+                self._unknown.discard(device_uuid)
+            if payload is None:
+                continue
+
+            try:
+                self.handler(device_uuid, payload)
+            except Exception as e:
+                logger.exception("Failed to handle status", extra={"device": device_uuid})
+            self.processed += 1
+
+    def depth(self):
+        return sum(work_queue.qsize() for work_queue in self._queues)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "queue_depth": self.depth(),
+            "max_queue_depth": self.max_depth,
+            "processed": self.processed,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+        }
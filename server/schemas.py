@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, DateTime
+from sqlalchemy import Column, Integer, String, DateTime
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -11,3 +11,12 @@ class Client(Base):
     notification_public_key = Column(String, nullable=False)
     status_public_key = Column(String, nullable=False)
     last_seen_online = Column(DateTime, nullable=True)
+
+class OutboxEntry(Base):
+    __tablename__ = "outbox"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    device_uuid = Column(String, index=True, nullable=False)
+    collapse_key = Column(String, nullable=True)
+    payload = Column(String, nullable=False)
+    queued_at = Column(DateTime, nullable=False)
@@ -0,0 +1,108 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+
+# Attributes every LogRecord has; anything else on a record came from `extra=` and is a field.
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "sampled"}
+
+_listener = None
+
+
+def _fields(record):
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES}
+
+
+class TextFormatter(logging.Formatter):
+    """`time level logger: message key=value ...`"""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = _fields(record)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with `extra=` fields as top-level keys."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(_fields(record))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps only `rate` of the records logged with `extra={"sampled": True}` below WARNING,
+    for lines emitted once per notification or status message.
+    """
+
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if getattr(record, "sampled", False) and record.levelno < logging.WARNING:
+            return self.rate >= 1 or random.random() < self.rate
+        return True
+
+
+def setup_logging(level="INFO", fmt="text", sample_rate=1.0, stream=None, app_loggers=("notifications",)):
+    """
+    Route all logging through a queue to a single writer thread, so request handlers,
+    paho's network threads and status workers never block on stdout.
+    DEBUG only applies to `app_loggers`; libraries stay at INFO.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_rate))
+
+    unknown_level = None
+    level = logging.getLevelName(str(level).upper())
+    if not isinstance(level, int):
+        # getLevelName returns "Level FOO" for names it doesn't know.
+        unknown_level, level = level, logging.INFO
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(max(level, logging.INFO))
+    for name in app_loggers:
+        logging.getLogger(name).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+    if unknown_level is not None:
+        logging.getLogger(__name__).warning("Unknown log level (%s); using INFO", unknown_level)
+    return _listener
+
+
+def stop_logging():
+    """Write out whatever is still queued."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
@@ -1,11 +1,15 @@
 from fastapi import HTTPException
+import json
 
 class Validate:
-    MAX_FIELD_SIZE = 245  # bytes
+    MAX_FIELD_SIZE = 245  # bytes, for devices that only accept RSA-encrypted fields (payload format 1)
+    MAX_HYBRID_FIELD_SIZE = 4096  # bytes, for devices that accept payload format 2
+    MAX_ENCRYPTED_PAYLOAD_SIZE = 16384  # bytes, for a pre-encrypted format 2 payload
+    MAX_BATCH_SIZE = 1000  # recipients
 
     @staticmethod
-    def check_field_length(value: str, field_name: str):
-        """Validate that a single field does not exceed MAX_FIELD_SIZE bytes."""
+    def check_field_length(value: str, field_name: str, max_size: int = MAX_FIELD_SIZE):
+        """Validate that a single field does not exceed `max_size` bytes."""
         if not isinstance(value, str):
             raise HTTPException(
                 status_code=400,
@@ -17,12 +21,48 @@ class Validate:
             )
 
         size = len(value.encode("utf-8"))
-        if size > Validate.MAX_FIELD_SIZE:
+        if size > max_size:
             raise HTTPException(
                 status_code=400,
                 detail={
                     "error": f"'{field_name}' too long",
-                    "requirements": f"Must be at most {Validate.MAX_FIELD_SIZE} bytes",
+                    "requirements": f"Must be at most {max_size} bytes",
                     "actual_size": size,
                 },
             )
+
+    @staticmethod
+    def check_batch_size(values: list, field_name: str):
+        """Validate that a batch is non-empty and has at most MAX_BATCH_SIZE entries."""
+        if not values or len(values) > Validate.MAX_BATCH_SIZE:
+            raise HTTPException(
+                status_code=400,
+                detail={
+                    "error": f"Invalid number of entries in '{field_name}'",
+                    "requirements": f"Must contain between 1 and {Validate.MAX_BATCH_SIZE} entries",
+                    "actual_size": len(values),
+                },
+            )
+
+    @staticmethod
+    def check_encrypted_payload(value: str, field_name: str):
+        """Validate the shape of a pre-encrypted format 2 payload: {"v": 2, "key", "nonce", "data"}."""
+        Validate.check_field_length(value, field_name, Validate.MAX_ENCRYPTED_PAYLOAD_SIZE)
+        try:
+            payload = json.loads(value)
+            valid = (
+                isinstance(payload, dict)
+                and payload.get("v") == 2
+                and all(isinstance(payload.get(key), str) and payload[key] for key in ("key", "nonce", "data"))
+            )
+        except ValueError:
+            valid = False
+
+        if not valid:
+            raise HTTPException(
+                status_code=400,
+                detail={
+                    "error": f"Invalid '{field_name}'",
+                    "requirements": 'Must be a JSON object with "v": 2 and base64 "key", "nonce" and "data" strings',
+                },
+            )
@@ -0,0 +1,220 @@
+"""
+Trim a staged pingberry-env folder down to what the client imports.
+
+Used by `build-pingberry-env.sh --trim`. Finds the import closure of the client scripts in the
+bundled standard library and site-packages, replaces the runtime with just those modules
+precompiled to .pyc (optionally the standard library in one lib/python311.zip, read by
+zipimport), drops tools the client doesn't use, and reports size and startup time before
+and after.
+
+Needs Python 3.11 on the build machine, so the .pyc files match the bundled interpreter.
+Startup is timed with the bundled interpreter, which only runs on the device; elsewhere
+pass --python, or run the printed command on the device.
+"""
+import argparse
+import io
+import modulefinder
+import os
+import py_compile
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+PYTHON_VERSION = (3, 11)
+LIB = Path("lib") / "python3.11"
+
+# Scripts run by run.sh and install.sh
+ENTRY_SCRIPTS = ("app/subscriber.py", "app/get_uuid.py", "app/keygen.py")
+# Imported by the install.sh heredoc, by the interpreter at startup, or by name at runtime
+# (codec lookups), where modulefinder can't see them.
+EXTRA_MODULES = ("requests", "json", "pathlib", "uuid", "site", "encodings", "_sysconfigdata__qnx_")
+# Only imported inside functions the client never calls (help, debuggers, doctests, other platforms).
+EXCLUDES = (
+    "pydoc", "doctest", "pdb", "bdb", "cmd", "code", "codeop", "rlcompleter", "unittest", "tkinter",
+    "webbrowser", "tracemalloc", "ftplib", "smtplib", "_pydecimal", "_aix_support", "_osx_support",
+    "_bootsubprocess", "nturl2path", "idlelib", "lib2to3",
+)
+# Only bash is needed by run.sh and install.sh.
+KEEP_BIN = ("bash",)
+# Imports everything the subscriber uses, including what it only imports once running
+# (rsa and the ASN.1 decoder for key parsing), then exits
+STARTUP_COMMAND = (
+    "-c", "import sys; sys.path.insert(0, 'app'); import subscriber, rsa, rsa.asn1, pyasn1.codec.der.decoder"
+)
+
+
+def find_closure(env_dir):
+    """Top-level names of the standard library modules/packages, site-packages packages and
+    extension modules the client scripts import."""
+    stdlib = env_dir / LIB
+    site_packages = stdlib / "site-packages"
+    dynload = stdlib / "lib-dynload"
+
+    finder = modulefinder.ModuleFinder(
+        path=[str(env_dir / "app"), str(stdlib), str(site_packages)], excludes=list(EXCLUDES)
+    )
+    for script in ENTRY_SCRIPTS:
+        finder.run_script(str(env_dir / script))
+    for name in EXTRA_MODULES:
+        try:
+            finder.import_hook(name)
+        except ImportError:
+            pass
+
+    # Modules the build machine has built in, and the bundle's extension modules (which
+    # modulefinder can't match), show up without a file or as missing.
+    names = {name.split(".")[0] for name in list(finder.modules) + list(finder.badmodules)} - set(EXCLUDES)
+
+    pure, extensions = set(), set()
+    for name in names:
+        if (stdlib / f"{name}.py").exists() or (stdlib / name / "__init__.py").exists():
+            pure.add(("stdlib", name))
+        elif (site_packages / name).is_dir() or (site_packages / f"{name}.py").exists():
+            pure.add(("site-packages", name))
+        else:
+            extensions.update(dynload.glob(f"{name}.*so"))
+    return pure, extensions
+
+
+def compile_tree(src, dest):
+    """Copy `src` (a module file or package) to `dest` as sourceless .pyc; other files as they are."""
+    files = [src] if src.is_file() else sorted(p for p in src.rglob("*") if p.is_file())
+    for path in files:
+        rel = path.relative_to(src.parent)
+        if "__pycache__" in rel.parts or rel.parts[1:2] in (("tests",), ("test",)):
+            continue
+        target = dest / rel
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if path.suffix == ".py":
+            try:
+                py_compile.compile(str(path), cfile=str(target.with_suffix(".pyc")), dfile=str(rel), doraise=True)
+                continue
+            except py_compile.PyCompileError:
+                pass  # Keep the source
+        shutil.copy2(path, target)
+
+
+def zip_stdlib(stdlib_dir, zip_path):
+    """Move the standard library's .pyc into one archive on the default sys.path. Stored, not
+    compressed: the device has no spare CPU for inflating, and zlib is itself an extension module."""
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_STORED) as archive:
+        for path in sorted(stdlib_dir.rglob("*")):
+            rel = path.relative_to(stdlib_dir)
+            if path.is_file() and rel.parts[0] not in ("site-packages", "lib-dynload"):
+                archive.write(path, str(rel))
+                # os.pyc stays behind: the interpreter finds its prefix by looking for it.
+                if str(rel) != "os.pyc":
+                    path.unlink()
+    for path in sorted(stdlib_dir.rglob("*"), reverse=True):
+        if path.is_dir() and not any(path.iterdir()):
+            path.rmdir()
+
+
+def trim(env_dir, use_zip):
+    pure, extensions = find_closure(env_dir)
+
+    staging = Path(tempfile.mkdtemp(dir=env_dir.parent))
+    try:
+        stdlib_out = staging / LIB
+        for location, name in sorted(pure):
+            base = env_dir / LIB if location == "stdlib" else env_dir / LIB / "site-packages"
+            out = stdlib_out if location == "stdlib" else stdlib_out / "site-packages"
+            src = base / name if (base / name).is_dir() else base / f"{name}.py"
+            compile_tree(src, out)
+            if location == "site-packages":
+                for dist_info in base.glob("*.dist-info"):
+                    record = dist_info / "RECORD"
+                    if record.exists() and f"\n{name}/" in "\n" + record.read_text():
+                        shutil.copytree(dist_info, out / dist_info.name)
+
+        (stdlib_out / "lib-dynload").mkdir(parents=True, exist_ok=True)
+        for extension in sorted(extensions):
+            shutil.copy2(extension, stdlib_out / "lib-dynload" / extension.name)
+
+        zip_path = staging / "lib" / "python311.zip"
+        if use_zip:
+            zip_stdlib(stdlib_out, zip_path)
+
+        # Only the Python library is replaced; anything else in lib/ (e.g. pkgconfig) stays.
+        shutil.rmtree(env_dir / LIB)
+        shutil.move(str(stdlib_out), str(env_dir / LIB))
+        if use_zip:
+            shutil.move(str(zip_path), str(env_dir / "lib" / zip_path.name))
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    for tool in (env_dir / "bin").iterdir():
+        if tool.name not in KEEP_BIN:
+            tool.unlink()
+
+    return len(pure), len(extensions)
+
+
+def bundle_size(env_dir):
+    """(bytes on disk, bytes once zipped for download)"""
+    files = [p for p in env_dir.rglob("*") if p.is_file()]
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for path in files:
+            archive.write(path, str(path.relative_to(env_dir)))
+    return sum(p.stat().st_size for p in files), buffer.tell()
+
+
+def startup_time(env_dir, python, runs=3):
+    """Best-of-`runs` seconds for the client to import everything, or None if the interpreter
+    can't run here. Nothing is written to __pycache__, as on a first start."""
+    command = [str(python or env_dir / "tools" / "python3" / "python3"), *STARTUP_COMMAND]
+    environment = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        try:
+            subprocess.run(command, cwd=env_dir, env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def _megabytes(size):
+    return f"{size / 1e6:.1f} MB"
+
+
+def _report(label, size, timing):
+    on_disk, zipped = size
+    line = f"{label}: {_megabytes(on_disk)} on disk, {_megabytes(zipped)} zipped"
+    if timing is not None:
+        line += f", startup {timing:.2f}s"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Trim a staged pingberry-env to the client's imports")
+    parser.add_argument("env_dir", type=Path, help="Staged pingberry-env folder (modified in place)")
+    parser.add_argument("--zip", action="store_true", help="Put the standard library in lib/python311.zip")
+    parser.add_argument("--python", help="Interpreter to time startup with (default: the bundled one)")
+    args = parser.parse_args()
+
+    if sys.version_info[:2] != PYTHON_VERSION:
+        sys.exit(f"Needs Python {'.'.join(map(str, PYTHON_VERSION))} to match the bundled runtime's .pyc format")
+
+    env_dir = args.env_dir.resolve()
+    before = bundle_size(env_dir), startup_time(env_dir, args.python)
+    modules, extensions = trim(env_dir, args.zip)
+    after = bundle_size(env_dir), startup_time(env_dir, args.python)
+
+    print(f"Kept {modules} modules/packages and {extensions} extension modules")
+    _report("Before", *before)
+    _report("After", *after)
+    if after[1] is None:
+        print("Startup not timed: the bundled interpreter doesn't run here. On the device, compare:")
+        print(f"  time tools/python3/python3 {shlex.join(STARTUP_COMMAND)}")
+
+
+if __name__ == "__main__":
+    main()